@@ -0,0 +1,221 @@
+'''
+Batch convert
+
+Converts many books without any prompts, several at a time, e.g. a whole season's list overnight.
+
+python3 batch_convert.py FOLDER_OR_MANIFEST [--jobs 4] [--summary summary.json]
+
+A folder is searched for *.pdf files. Each book's cover is the jpg/jpeg with the same name and its metadata the json with the same name (optional):
+    9781234567890.pdf
+    9781234567890.jpg
+    9781234567890.json   {"title": "...", "author": "...", "isbn": "...", ...}
+
+A manifest is a csv file with the columns pdf, cover and metadata (paths relative to the manifest).
+
+Fonts are read from the "fonts" folder next to each pdf. A book that fails is reported in the summary and the others carry on.
+'''
+
+import os
+import csv
+import json
+import time
+import argparse
+import traceback
+import contextlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+### Contents
+# find_books_in_folder
+# read_manifest
+# convert_one
+# run_batch
+# convert_in_pool
+# print_progress
+# print_summary
+
+def find_books_in_folder(folder_path):
+    """Finds each pdf in the folder with its cover and metadata file (same name)."""
+    books = []
+    for file_name in sorted(os.listdir(folder_path)):
+        if not file_name.lower().endswith(".pdf"):
+            continue
+        base_path = os.path.join(folder_path, os.path.splitext(file_name)[0])
+
+        cover_path = None
+        for extension in (".jpg", ".jpeg", ".JPG", ".JPEG"):
+            if os.path.exists(base_path + extension):
+                cover_path = base_path + extension
+                break
+
+        metadata_path = base_path + ".json"
+        books.append({
+            "pdf": os.path.join(folder_path, file_name),
+            "cover": cover_path,
+            "metadata": metadata_path if os.path.exists(metadata_path) else None,
+        })
+    return books
+
+def read_manifest(manifest_path):
+    """Reads the pdf/cover/metadata rows of a csv manifest."""
+    manifest_folder = os.path.dirname(os.path.abspath(manifest_path))
+    books = []
+    with open(manifest_path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            book = {}
+            for column in ("pdf", "cover", "metadata"):
+                value = (row.get(column) or "").strip()
+                book[column] = os.path.join(manifest_folder, value) if value else None
+            books.append(book)
+    return books
+
+def convert_one(book, options):
+    """
+    Converts one book in a worker process. Never raises: errors are returned in the result.
+    The conversion output goes to <name>_convert.log next to the pdf so parallel books don't mix their output.
+    """
+    start = time.perf_counter()
+    started_at = time.time()
+    result = {
+        "pdf": book["pdf"],
+        "status": "failed",
+        "seconds": 0,
+        "pdf_bytes": None,
+        "epub": None,
+        "epub_bytes": None,
+        "pages": None,
+        "error": None,
+    }
+    log_path = os.path.splitext(book["pdf"])[0] + "_convert.log"
+    epub_path = os.path.splitext(book["pdf"])[0] + ".epub"
+
+    try:
+        result["pdf_bytes"] = os.path.getsize(book["pdf"])
+        if not book["cover"] or not os.path.exists(book["cover"]):
+            raise FileNotFoundError(f"No cover image found for {os.path.basename(book['pdf'])}")
+
+        metadata = {}
+        if book["metadata"]:
+            with open(book["metadata"], encoding="utf-8") as f:
+                metadata = json.load(f)
+
+        # Imported here so each worker process loads the converter once
+        from convert_fixed_epub import convert_book
+
+        with open(log_path, "w", encoding="utf-8") as log_file, contextlib.redirect_stdout(log_file):
+            converted = convert_book(book["pdf"], book["cover"], metadata, options)
+
+        result.update({
+            "status": "ok",
+            "epub": converted["epub_path"],
+            "epub_bytes": converted["epub_bytes"],
+            "pages": converted["pages"],
+        })
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        # Don't leave a half written epub behind
+        if os.path.exists(epub_path) and os.path.getmtime(epub_path) >= started_at:
+            os.remove(epub_path)
+        with open(log_path, "a", encoding="utf-8") as log_file:
+            log_file.write(traceback.format_exc())
+
+    result["seconds"] = round(time.perf_counter() - start, 2)
+    return result
+
+def run_batch(books, jobs, options=None):
+    """
+    Converts the books over jobs processes. Returns one result per book, in the order given.
+
+    A worker process that dies (e.g. a crash inside MuPDF) breaks the whole pool, and every book converting in it fails with it.
+    Those books are converted again one at a time, each in a pool of its own, so only the book that crashed is marked failed.
+    The remaining books go on in a new pool.
+    """
+    results = [None] * len(books)
+    waiting = deque(range(len(books)))
+
+    while waiting:
+        for index in convert_in_pool(books, waiting, jobs, options or {}, results):
+            started_at = time.time()
+            if convert_in_pool(books, deque([index]), 1, options or {}, results):
+                results[index] = {"pdf": books[index]["pdf"], "status": "failed",
+                                  "error": "The worker process died converting this book (e.g. a crash inside MuPDF)"}
+                # The worker couldn't remove its half written epub
+                epub_path = os.path.splitext(books[index]["pdf"])[0] + ".epub"
+                if os.path.exists(epub_path) and os.path.getmtime(epub_path) >= started_at:
+                    os.remove(epub_path)
+                print_progress(results, index)
+
+    return results
+
+def convert_in_pool(books, waiting, jobs, options, results):
+    """
+    Converts the waiting books (a deque of indexes) in a new pool of jobs processes, with no more submitted than can run.
+    Returns the indexes of the books that were converting when the pool broke, empty when it didn't.
+    """
+    converting = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while waiting or converting:
+            while waiting and len(converting) < jobs:
+                index = waiting.popleft()
+                converting[executor.submit(convert_one, books[index], options)] = index
+
+            done, _ = wait(converting, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = converting.pop(future)
+                try:
+                    results[index] = future.result()
+                except BrokenProcessPool:
+                    return sorted([index] + list(converting.values()))
+                except Exception as e:
+                    # e.g. the book's options couldn't be sent to the worker
+                    results[index] = {"pdf": books[index]["pdf"], "status": "failed", "error": f"{type(e).__name__}: {e}"}
+                print_progress(results, index)
+    return []
+
+def print_progress(results, index):
+    result = results[index]
+    print(f"[{sum(r is not None for r in results)}/{len(results)}] {result['status']:6} {os.path.basename(result['pdf'])}" +
+          (f"  {result['error']}" if result.get("error") else f"  {result['seconds']} s"))
+
+def print_summary(results, total_seconds):
+    converted = [result for result in results if result["status"] == "ok"]
+    print(f"\n{len(converted)} of {len(results)} books converted in {total_seconds:.1f} s\n")
+    print(f"{'book':40} {'status':7} {'pages':>6} {'seconds':>8} {'pdf MB':>8} {'epub MB':>8}")
+    for result in results:
+        def megabytes(value):
+            return f"{value / (1024 * 1024):.1f}" if value else "-"
+        print(f"{os.path.basename(result['pdf'])[:40]:40} {result['status']:7} {result.get('pages') or '-':>6} "
+              f"{result.get('seconds', '-'):>8} {megabytes(result.get('pdf_bytes')):>8} {megabytes(result.get('epub_bytes')):>8}")
+    for result in results:
+        if result.get("error"):
+            print(f"\n{os.path.basename(result['pdf'])}: {result['error']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert many InDesign pdfs to fixed-layout epubs without prompts")
+    parser.add_argument("source", help="Folder of pdfs (with same-named cover jpg and metadata json) or a csv manifest with pdf, cover and metadata columns")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of books converted at the same time")
+    parser.add_argument("--summary", help="Where to write the json summary (default: batch_summary.json in the source folder)")
+    parser.add_argument("--subset-fonts", action="store_true", help="Cut the fonts down to the characters used in each book (needs fontTools)")
+    parser.add_argument("--minify", action="store_true", help="Strip whitespace between tags in the xhtml")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        books = find_books_in_folder(args.source)
+        summary_path = args.summary or os.path.join(args.source, "batch_summary.json")
+    else:
+        books = read_manifest(args.source)
+        summary_path = args.summary or os.path.join(os.path.dirname(os.path.abspath(args.source)), "batch_summary.json")
+
+    options = {"subset_fonts": args.subset_fonts, "minify_html": args.minify}
+
+    print(f"Converting {len(books)} books, {args.jobs} at a time")
+    start = time.perf_counter()
+    results = run_batch(books, args.jobs, options)
+    total_seconds = time.perf_counter() - start
+
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump({"total_seconds": round(total_seconds, 2), "books": results}, f, indent=4)
+
+    print_summary(results, total_seconds)
+    print(f"\nSummary written to {summary_path}")
@@ -0,0 +1,93 @@
+'''
+Benchmark: peak memory against page count
+
+Converts synthetic pdfs of growing page count (see make_synthetic_pdf.py) and checks that the peak memory of low-memory mode stays flat:
+the peak of the longest pdf may be at most --max-growth-mb above the peak of the shortest. Exits with 1 if it isn't.
+Each conversion runs in its own process and the memory is sampled from a thread, as low-memory mode resets the kernel's peak counter for its per-stage peaks.
+
+python benchmarks/bench_memory.py --pages 50 200 800 --compare
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, ".."))
+
+from make_synthetic_pdf import make_synthetic_pdf
+
+def run_conversion(pdf_path, low_memory, workers):
+    """Converts the pdf in this process while a thread samples the resident memory. Prints the seconds and peak MB as json."""
+    from memory_guard import current_rss_mb
+    from converter import Converter, ConversionOptions
+
+    peak = [current_rss_mb()]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], current_rss_mb())
+            time.sleep(0.002)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    converter = Converter(ConversionOptions(low_memory=low_memory, workers=workers, write_report=False))
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as out_folder, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        converter.convert(pdf_path, os.path.join(os.path.dirname(pdf_path), "cover.jpg"), epub_path=os.path.join(out_folder, "book.epub"))
+    seconds = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    print(json.dumps({"seconds": seconds, "peak_mb": max(peak[0], current_rss_mb())}))
+
+def measure(pdf_path, low_memory, workers):
+    command = [sys.executable, __file__, "--run", pdf_path, "--workers", str(workers)] + (["--low-memory"] if low_memory else [])
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks that low-memory mode's peak memory stays flat as the page count grows")
+    parser.add_argument("--pages", type=int, nargs="+", default=[50, 200, 600], help="Page counts to convert")
+    parser.add_argument("--image-width", type=int, default=800)
+    parser.add_argument("--image-height", type=int, default=1000)
+    parser.add_argument("--spans", type=int, default=150, help="Text spans per page")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-growth-mb", type=float, default=10, help="Largest allowed peak increase from the fewest to the most pages")
+    parser.add_argument("--compare", action="store_true", help="Also convert without low-memory mode")
+    parser.add_argument("--pdfs-folder", default=os.path.join(tempfile.gettempdir(), "pdf2epub_benchmark_pdfs"), help="Where the generated pdfs are kept between runs")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--low-memory", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_conversion(args.run, args.low_memory, args.workers)
+        raise SystemExit
+
+    modes = [True, False] if args.compare else [True]
+    peaks = {}
+    print(f"{'pages':>6} {'mode':12} {'seconds':>8} {'peak MB':>8}")
+    for pages in sorted(args.pages):
+        scenario_folder = os.path.join(args.pdfs_folder, f"memory_{pages}p_{args.image_width}x{args.image_height}_{args.spans}s")
+        pdf_path = os.path.join(scenario_folder, "book.pdf")
+        if not os.path.exists(pdf_path):
+            os.makedirs(os.path.join(scenario_folder, "fonts"), exist_ok=True)
+            make_synthetic_pdf(pdf_path, pages, args.image_width, args.image_height, "rgb", args.spans, 2)
+
+        for low_memory in modes:
+            result = measure(pdf_path, low_memory, args.workers)
+            peaks.setdefault(low_memory, []).append(result["peak_mb"])
+            print(f"{pages:6} {'low-memory' if low_memory else 'default':12} {result['seconds']:8.2f} {result['peak_mb']:8.1f}")
+
+    growth = peaks[True][-1] - peaks[True][0]
+    print(f"\nLow-memory peak growth from {min(args.pages)} to {max(args.pages)} pages: {growth:+.1f} MB (allowed {args.max_growth_mb} MB)")
+    if args.compare:
+        print(f"Default mode growth: {peaks[False][-1] - peaks[False][0]:+.1f} MB")
+    if growth > args.max_growth_mb:
+        raise SystemExit(1)
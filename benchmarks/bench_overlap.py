@@ -0,0 +1,75 @@
+'''
+Benchmark: pipelined against sequential conversion
+
+Converts synthetic pdfs (see make_synthetic_pdf.py) with the stages one after another and pipelined (--pipeline-threads) with each
+thread count, and prints the median wall time of --repeat runs and the speedup. The epubs of all runs are checked to be the same.
+The overlap needs free cores: on a single core the pipelined run can only hide I/O, so expect about the same time there.
+
+python benchmarks/bench_overlap.py --threads 1 2 4 --repeat 3
+'''
+
+import argparse
+import contextlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, ".."))
+
+from make_synthetic_pdf import make_synthetic_pdf
+
+# name: (pages, image width, image height, colorspace, spans)
+SCENARIOS = {
+    "rgb": (40, 1800, 2400, "rgb", 150),
+    "cmyk": (40, 1800, 2400, "cmyk", 150),
+    "text_heavy": (40, 800, 1000, "rgb", 1200),
+}
+
+def epub_members(epub_path):
+    """The epub's members and their bytes, without content.opf's modified date."""
+    with zipfile.ZipFile(epub_path) as epub_file:
+        return [(name, epub_file.read(name) if name != "OEBPS/content.opf" else b"") for name in epub_file.namelist()]
+
+def time_conversion(pdf_path, epub_path, pipeline_threads, repeat):
+    from converter import Converter, ConversionOptions
+    converter = Converter(ConversionOptions(pipeline_threads=pipeline_threads, write_report=False))
+    cover_path = os.path.join(os.path.dirname(pdf_path), "cover.jpg")
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            converter.convert(pdf_path, cover_path, epub_path=epub_path)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares pipelined and sequential conversion wall time")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4], help="Image encoding thread counts to try")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per mode, the median is reported")
+    parser.add_argument("--pdfs-folder", default=os.path.join(tempfile.gettempdir(), "pdf2epub_benchmark_pdfs"), help="Where the generated pdfs are kept between runs")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cpus")
+    print(f"{'scenario':12} {'mode':12} {'seconds':>8} {'speedup':>8}")
+    for scenario in args.scenarios:
+        pages, image_width, image_height, colorspace, spans = SCENARIOS[scenario]
+        scenario_folder = os.path.join(args.pdfs_folder, f"overlap_{scenario}_{pages}p")
+        pdf_path = os.path.join(scenario_folder, "book.pdf")
+        if not os.path.exists(pdf_path):
+            os.makedirs(os.path.join(scenario_folder, "fonts"), exist_ok=True)
+            make_synthetic_pdf(pdf_path, pages, image_width, image_height, colorspace, spans, 2)
+
+        with tempfile.TemporaryDirectory() as out_folder:
+            sequential = time_conversion(pdf_path, os.path.join(out_folder, "sequential.epub"), 0, args.repeat)
+            print(f"{scenario:12} {'sequential':12} {sequential:8.2f} {1:8.2f}")
+            expected = epub_members(os.path.join(out_folder, "sequential.epub"))
+            for threads in args.threads:
+                epub_path = os.path.join(out_folder, f"pipelined_{threads}.epub")
+                seconds = time_conversion(pdf_path, epub_path, threads, args.repeat)
+                same = epub_members(epub_path) == expected
+                print(f"{scenario:12} {f'{threads} threads':12} {seconds:8.2f} {sequential / seconds:8.2f}{'' if same else '  EPUB DIFFERS'}")
@@ -0,0 +1,181 @@
+'''
+Benchmark suite: conversion stages
+
+Generates synthetic InDesign-like pdfs (see make_synthetic_pdf.py), times each stage of the conversion on them and records the peak memory,
+then compares the results with the stored baseline (benchmarks/baseline.json) and flags anything slower or bigger than --threshold.
+Each stage runs in its own process so its peak memory is measured on its own. Exits with 1 if there is a regression.
+
+Stages:
+    convert       create_epub_structure_from_pdf, the whole conversion straight into the epub
+    images        process_images, the standalone background image pass
+    zip           zip_folder_to_epub, packing an exploded epub folder
+    scan_fonts    scan_fonts, the font inventory
+
+python benchmarks/bench_pipeline.py                       run the standard scenarios and compare with the baseline
+python benchmarks/bench_pipeline.py --save-baseline       run them and store the results as the new baseline
+python benchmarks/bench_pipeline.py --pages 200 --colorspace cmyk --spans 300 --fonts 6 --image-width 2400 --image-height 3200
+                                                          run one custom scenario (compared only if the baseline has it)
+
+Timings depend on the machine: save a baseline on the machine the comparison runs on.
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, ".."))
+
+from make_synthetic_pdf import make_synthetic_pdf
+from memory_guard import peak_rss_mb
+
+BASELINE_PATH = os.path.join(BENCHMARK_FOLDER, "baseline.json")
+STAGES = ("convert", "images", "zip", "scan_fonts")
+
+# name: (pages, image width, image height, colorspace, spans per page, fonts)
+SCENARIOS = {
+    "rgb": (20, 1200, 1600, "rgb", 60, 2),
+    "cmyk": (20, 1200, 1600, "cmyk", 60, 2),
+    "text_heavy": (20, 800, 1000, "rgb", 400, 8),
+    "large_images": (6, 3000, 4000, "rgb", 40, 2),
+}
+
+def run_stage(stage, pdf_path, work_folder):
+    """Runs one stage in this process and prints its time and peak memory as json."""
+    import convert_fixed_epub
+
+    cover_path = os.path.join(os.path.dirname(pdf_path), "cover.jpg")
+    font_folder = os.path.join(os.path.dirname(pdf_path), "fonts")
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if stage == "convert":
+            convert_fixed_epub.convert_book(pdf_path, cover_path, epub_path=os.path.join(work_folder, "convert.epub"), font_folder=font_folder)
+        elif stage == "images":
+            convert_fixed_epub.process_images(pdf_path, os.path.join(work_folder, "images_html"))
+        elif stage == "zip":
+            convert_fixed_epub.zip_folder_to_epub(os.path.join(os.path.dirname(pdf_path), "book_html"), os.path.join(work_folder, "zip.epub"))
+        elif stage == "scan_fonts":
+            convert_fixed_epub.scan_fonts(pdf_path, font_folder)
+        seconds = time.perf_counter() - start
+
+    print(json.dumps({"seconds": seconds, "peak_rss_mb": peak_rss_mb()}))
+
+def prepare_scenario(name, settings, pdfs_folder):
+    """Generates the scenario's pdf (once, it is kept between runs) and the exploded epub folder the zip stage packs."""
+    pages, image_width, image_height, colorspace, spans, fonts = settings
+    scenario_folder = os.path.join(pdfs_folder, f"{name}_{pages}p_{image_width}x{image_height}_{colorspace}_{spans}s_{fonts}f")
+    pdf_path = os.path.join(scenario_folder, "book.pdf")
+
+    if not os.path.exists(pdf_path):
+        os.makedirs(os.path.join(scenario_folder, "fonts"), exist_ok=True)
+        make_synthetic_pdf(pdf_path, pages, image_width, image_height, colorspace, spans, fonts)
+
+        from convert_fixed_epub import convert_book
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            convert_book(pdf_path, os.path.join(scenario_folder, "cover.jpg"),
+                         epub_path=os.path.join(scenario_folder, "book.epub"), output_folder=os.path.join(scenario_folder, "book_html"))
+    return pdf_path
+
+def measure(stage, pdf_path, repeat):
+    """Median time and largest peak memory of repeat runs of the stage, each in a fresh process."""
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work_folder:
+            output = subprocess.run([sys.executable, __file__, "--run-stage", stage, "--pdf", pdf_path, "--work-folder", work_folder],
+                                    check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "seconds": round(statistics.median(run["seconds"] for run in runs), 4),
+        "peak_rss_mb": round(max(run["peak_rss_mb"] for run in runs), 1),
+    }
+
+def compare(results, baseline, threshold, noise_seconds=0.02):
+    """Prints each result against the baseline. Returns the regressions. Time differences under noise_seconds are never flagged, so stages of a few ms don't flag on jitter."""
+    regressions = []
+    print(f"\n{'scenario':14} {'stage':11} {'seconds':>9} {'baseline':>9} {'change':>8} {'peak MB':>8} {'baseline':>9} {'change':>8}")
+    for scenario, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(scenario, {}).get(stage)
+            line = f"{scenario:14} {stage:11} {result['seconds']:9.3f}"
+            if not base:
+                print(f"{line} {'-':>9} {'':>8} {result['peak_rss_mb']:8.1f} {'-':>9}")
+                continue
+
+            time_change = result["seconds"] / base["seconds"] - 1 if base["seconds"] else 0
+            memory_change = result["peak_rss_mb"] / base["peak_rss_mb"] - 1 if base["peak_rss_mb"] else 0
+            flags = []
+            if time_change > threshold and result["seconds"] - base["seconds"] > noise_seconds:
+                flags.append("SLOWER")
+            if memory_change > threshold:
+                flags.append("MORE MEMORY")
+            if flags:
+                regressions.append((scenario, stage, flags))
+            print(f"{line} {base['seconds']:9.3f} {time_change:+8.0%} {result['peak_rss_mb']:8.1f} {base['peak_rss_mb']:9.1f} {memory_change:+8.0%}  {' '.join(flags)}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times each conversion stage on synthetic pdfs and compares with the stored baseline")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), help="Standard scenarios to run (default: all)")
+    parser.add_argument("--pages", type=int, help="Run one custom scenario with these settings instead")
+    parser.add_argument("--image-width", type=int, default=1200)
+    parser.add_argument("--image-height", type=int, default=1600)
+    parser.add_argument("--colorspace", choices=["rgb", "cmyk"], default="rgb")
+    parser.add_argument("--spans", type=int, default=60, help="Text spans per page")
+    parser.add_argument("--fonts", type=int, default=2, help="Number of different fonts (up to 14)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage, the median time is used")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Flag stages more than this much slower or bigger than the baseline (0.15 = 15%%)")
+    parser.add_argument("--noise-seconds", type=float, default=0.02, help="Time differences smaller than this are not flagged")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the baseline instead of comparing")
+    parser.add_argument("--pdfs-folder", default=os.path.join(tempfile.gettempdir(), "pdf2epub_benchmark_pdfs"), help="Where the generated pdfs are kept between runs")
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--pdf", help=argparse.SUPPRESS)
+    parser.add_argument("--work-folder", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args.run_stage, args.pdf, args.work_folder)
+        raise SystemExit
+
+    if args.pages:
+        scenarios = {"custom": (args.pages, args.image_width, args.image_height, args.colorspace, args.spans, args.fonts)}
+    else:
+        scenarios = {name: SCENARIOS[name] for name in (args.scenarios or SCENARIOS)}
+
+    results = {}
+    for name, settings in scenarios.items():
+        print(f"{name}: {settings[0]} pages, {settings[1]}x{settings[2]} {settings[3]}, {settings[4]} spans/page, {settings[5]} fonts")
+        pdf_path = prepare_scenario(name, settings, args.pdfs_folder)
+        results[name] = {stage: measure(stage, pdf_path, args.repeat) for stage in args.stages}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    regressions = compare(results, baseline.get("results", {}), args.threshold, args.noise_seconds)
+
+    if args.save_baseline:
+        # keep the stored results of scenarios and stages that were not run this time
+        for scenario, stages in results.items():
+            baseline.setdefault("results", {}).setdefault(scenario, {}).update(stages)
+        baseline["machine"] = f"{platform.system()} {platform.machine()}, Python {platform.python_version()}, {os.cpu_count()} cpus"
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=4)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}:")
+        for scenario, stage, flags in regressions:
+            print(f"    {scenario} {stage}: {', '.join(flags).lower()}")
+        raise SystemExit(1)
+    elif baseline:
+        print(f"\nNo regressions beyond {args.threshold:.0%}")
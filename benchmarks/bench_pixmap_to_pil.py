@@ -0,0 +1,124 @@
+'''
+Micro-benchmark: Pixmap to PIL handoff
+
+Compares the old PNG round-trip (pix.tobytes() -> io.BytesIO -> Image.open -> convert("RGB")) with pixmap_to_image,
+on a full-page background of the given size. Each method runs in its own process so peak memory is measured separately.
+First checks that both give the same colours for semi-transparent pixels (MuPDF premultiplies them by alpha), and that a soft-masked
+background encoded as png or webp keeps them, and exits with 1 if they don't.
+
+python benchmarks/bench_pixmap_to_pil.py --width 5000 --height 6000 --pages 3
+'''
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from memory_guard import peak_rss_mb
+
+def make_pixmap(width, height, colorspace, alpha):
+    import pymupdf
+    cs = {"rgb": pymupdf.csRGB, "cmyk": pymupdf.csCMYK, "gray": pymupdf.csGRAY}[colorspace]
+    pix = pymupdf.Pixmap(cs, pymupdf.IRect(0, 0, width, height), alpha)
+    pix.clear_with(128)
+    # some structure so the encoders have real work to do
+    for x in range(0, width, 97):
+        pix.set_rect(pymupdf.IRect(x, 0, x + 40, height), tuple([x % 255] * pix.n))
+    return pix
+
+def old_handoff(pix):
+    from PIL import Image
+    image = Image.open(io.BytesIO(pix.tobytes()))
+    return image.convert("RGB")
+
+def new_handoff(pix):
+    from PIL import Image
+    from convert_fixed_epub import pixmap_to_image
+    image = pixmap_to_image(pix)
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+def check_alpha():
+    """Semi-transparent pixels through pixmap_to_image and through the PNG round-trip, with gray and RGB. Returns the mismatches."""
+    import pymupdf
+    from PIL import Image
+    from convert_fixed_epub import pixmap_to_image
+    mismatches = []
+    for mode, color in (("RGBA", (200, 100, 50, 128)), ("RGBA", (30, 220, 90, 40)), ("LA", (180, 200))):
+        data = io.BytesIO()
+        Image.new(mode, (8, 8), color).save(data, "PNG")
+        pix = pymupdf.Pixmap(data.getvalue())
+        direct = pixmap_to_image(pix).getpixel((3, 3))
+        png = Image.open(io.BytesIO(pix.tobytes("png"))).getpixel((3, 3))
+        # un-premultiplying rounds a little differently from MuPDF's png writer
+        if any(abs(a - b) > 2 for a, b in zip(direct, png)):
+            mismatches.append(f"{mode} {color}: pixmap_to_image {direct}, png {png}")
+    return mismatches
+
+def check_soft_mask():
+    """A semi-transparent background (an image with a soft mask in the pdf) encoded by the format chooser, read back. Returns the mismatches."""
+    import pymupdf
+    from PIL import Image
+    import convert_fixed_epub
+    mismatches = []
+    color = (200, 100, 50, 128)
+    data = io.BytesIO()
+    Image.new("RGBA", (64, 64), color).save(data, "PNG")
+    doc = pymupdf.open()
+    page = doc.new_page(width=64, height=64)
+    page.insert_image(page.rect, stream=data.getvalue())
+    img = page.get_images(full=True)[-1]
+    for image_formats in (("png",), ("webp",), ("jpeg", "png", "webp")):
+        convert_fixed_epub.image_formats = image_formats
+        image_data, image_path, extension = convert_fixed_epub.encode_page_image(doc, img)
+        decoded = Image.open(io.BytesIO(image_data)).convert("RGBA").getpixel((32, 32))
+        if any(abs(a - b) > 2 for a, b in zip(decoded, color)):
+            mismatches.append(f"soft mask as {extension} from {'/'.join(image_formats)}: {decoded}, expected {color}")
+    convert_fixed_epub.image_formats = ("jpeg",)
+    doc.close()
+    return mismatches
+
+def run_method(method, args):
+    import pymupdf
+    pix = make_pixmap(args.width, args.height, args.colorspace, args.alpha)
+    base_rss = peak_rss_mb()
+    handoff = old_handoff if method == "png" else new_handoff
+    times = []
+
+    for _ in range(args.pages):
+        start = time.perf_counter()
+        page_pix = pix
+        if page_pix.colorspace.n == 4:
+            page_pix = pymupdf.Pixmap(pymupdf.csRGB, page_pix)
+        image = handoff(page_pix)
+        image.save(io.BytesIO(), "JPEG")
+        image.close()
+        page_pix = None
+        times.append(time.perf_counter() - start)
+
+    print(f"{method:>8}: {sum(times) / len(times):.3f} s/page, peak memory +{peak_rss_mb() - base_rss:.0f} MB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pixmap to PIL handoff micro-benchmark")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=5000)
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--colorspace", choices=["rgb", "cmyk", "gray"], default="rgb")
+    parser.add_argument("--alpha", action="store_true")
+    parser.add_argument("--method", choices=["png", "direct"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method:
+        run_method(args.method, args)
+    else:
+        mismatches = check_alpha() + check_soft_mask()
+        for mismatch in mismatches:
+            print(f"Alpha mismatch: {mismatch}")
+        if mismatches:
+            raise SystemExit(1)
+        print(f"{args.width}x{args.height} {args.colorspace}{' + alpha' if args.alpha else ''}, {args.pages} pages (time includes the JPEG encode)")
+        for method in ("png", "direct"):
+            subprocess.run([sys.executable, __file__, "--method", method] + sys.argv[1:], check=True)
@@ -0,0 +1,83 @@
+'''
+Benchmark: startup cost
+
+Measures what a fresh process pays before it can convert: the import time of converter and convert_fixed_epub and which heavy modules they pull in.
+With --pdf and --cover it also converts the book --books times, once in a fresh process per book and once with one long-lived Converter, so the per-book startup cost can be compared.
+
+python benchmarks/bench_startup.py --repeat 5
+python benchmarks/bench_startup.py --pdf book.pdf --cover cover.jpg --books 5
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HEAVY_MODULES = ("pymupdf", "PIL.Image", "titlecase", "tkinter")
+
+IMPORT_SCRIPT = '''
+import sys, time, json
+sys.path.insert(0, {folder!r})
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+CONVERT_SCRIPT = '''
+import sys, os, time, json, contextlib
+sys.path.insert(0, {folder!r})
+start = time.perf_counter()
+from converter import Converter
+converter = Converter()
+with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    for book in range({books}):
+        converter.convert({pdf!r}, {cover!r}, epub_path=os.path.join({out!r}, f"book_{{book}}.epub"))
+print(json.dumps({{"seconds": time.perf_counter() - start}}))
+'''
+
+def run_script(script):
+    output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def time_imports(repeat):
+    for module in ("converter", "convert_fixed_epub"):
+        results = [run_script(IMPORT_SCRIPT.format(folder=PACKAGE_FOLDER, module=module, heavy=HEAVY_MODULES)) for _ in range(repeat)]
+        seconds = statistics.median(result["seconds"] for result in results)
+        loaded = ", ".join(results[0]["loaded"]) or "none"
+        print(f"import {module:20} {seconds * 1000:7.1f} ms   heavy modules loaded: {loaded}")
+
+def time_books(pdf_path, cover_path, books):
+    pdf_path = os.path.abspath(pdf_path)
+    cover_path = os.path.abspath(cover_path)
+    with tempfile.TemporaryDirectory() as out_folder:
+        start = time.perf_counter()
+        for _ in range(books):
+            subprocess.run([sys.executable, "-c", CONVERT_SCRIPT.format(folder=PACKAGE_FOLDER, books=1, pdf=pdf_path, cover=cover_path, out=out_folder)],
+                           check=True, capture_output=True)
+        fresh_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", CONVERT_SCRIPT.format(folder=PACKAGE_FOLDER, books=books, pdf=pdf_path, cover=cover_path, out=out_folder)],
+                       check=True, capture_output=True)
+        reused_seconds = time.perf_counter() - start
+
+    print(f"\n{books} books, fresh process per book: {fresh_seconds:.2f} s ({fresh_seconds / books:.3f} s/book)")
+    print(f"{books} books, one long-lived Converter: {reused_seconds:.2f} s ({reused_seconds / books:.3f} s/book)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup cost benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh processes per import measurement (the median is shown)")
+    parser.add_argument("--pdf", help="Book to convert for the per-book comparison")
+    parser.add_argument("--cover", help="Cover image for --pdf")
+    parser.add_argument("--books", type=int, default=5)
+    args = parser.parse_args()
+
+    time_imports(args.repeat)
+    if args.pdf and args.cover:
+        time_books(args.pdf, args.cover, args.books)
@@ -0,0 +1,96 @@
+'''
+Benchmark: packing the epub
+
+Converts a synthetic pdf (see make_synthetic_pdf.py) keeping the exploded epub folder, then packs that folder the old way (every member
+deflated) and with zip_folder_to_epub's packer (images stored unless they still deflate, text deflated) at each level and thread count.
+Prints the median time of --repeat runs, the epub size and the result of the OCF check. Every member of each packed epub is read back
+(zipfile.testzip) and the benchmark exits with 1 if one is damaged.
+
+python benchmarks/bench_zip.py --photo --threads 0 2 4 --levels 6 9
+'''
+
+import argparse
+import contextlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_FOLDER, ".."))
+
+from make_synthetic_pdf import make_synthetic_pdf
+from epub_writer import check_ocf
+
+def deflate_all(folder_path, epub_path):
+    """The packer before media types were told apart: the mimetype stored, everything else deflated."""
+    with zipfile.ZipFile(epub_path, 'w', zipfile.ZIP_STORED) as epub_file:
+        epub_file.writestr('mimetype', 'application/epub+zip')
+        for root, dirs, files in os.walk(folder_path):
+            for file in files:
+                if file != 'mimetype':
+                    file_path = os.path.join(root, file)
+                    epub_file.write(file_path, os.path.relpath(file_path, folder_path), compress_type=zipfile.ZIP_DEFLATED)
+
+def check_epub(epub_path):
+    """The OCF check and testzip's read back of every member, as a column for the table. Returns it and whether the epub is sound."""
+    with zipfile.ZipFile(epub_path) as epub_file:
+        bad_member = epub_file.testzip()
+    problems = check_ocf(epub_path) + ([f"{bad_member} is damaged"] if bad_member else [])
+    return "; ".join(problems) or "ok", not bad_member
+
+def time_packing(pack, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pack()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times packing the epub by media type against deflating every member")
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--spans", type=int, default=600, help="Text spans per page")
+    parser.add_argument("--photo", action="store_true", help="Grainy backgrounds that compress like photos (default: smooth ones that deflate like flat art)")
+    parser.add_argument("--threads", type=int, nargs="+", default=[0, 2, 4], help="zip_threads values to try")
+    parser.add_argument("--levels", type=int, nargs="+", default=[6], help="zip_level values to try")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per mode, the median is reported")
+    parser.add_argument("--pdfs-folder", default=os.path.join(tempfile.gettempdir(), "pdf2epub_benchmark_pdfs"), help="Where the generated pdfs are kept between runs")
+    args = parser.parse_args()
+
+    import convert_fixed_epub
+    from converter import Converter, ConversionOptions
+
+    scenario_folder = os.path.join(args.pdfs_folder, f"zip_{args.pages}p_{args.spans}s{'_photo' if args.photo else ''}")
+    pdf_path = os.path.join(scenario_folder, "book.pdf")
+    if not os.path.exists(pdf_path):
+        os.makedirs(os.path.join(scenario_folder, "fonts"), exist_ok=True)
+        make_synthetic_pdf(pdf_path, args.pages, 1200, 1600, "rgb", args.spans, 2, photo=args.photo)
+
+    with tempfile.TemporaryDirectory() as out_folder:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            Converter(ConversionOptions(write_report=False), keep_html=True).convert(
+                pdf_path, os.path.join(scenario_folder, "cover.jpg"), epub_path=os.path.join(out_folder, "book.epub"))
+        folder_path = os.path.join(out_folder, "book_html")
+        epub_path = os.path.join(out_folder, "packed.epub")
+
+        print(f"{os.cpu_count()} cpus, {args.pages} pages, {'photo' if args.photo else 'smooth'} backgrounds")
+        print(f"{'mode':28} {'seconds':>8} {'epub KB':>8}  OCF and members")
+        seconds = time_packing(lambda: deflate_all(folder_path, epub_path), args.repeat)
+        checked, sound = check_epub(epub_path)
+        print(f"{'deflate all':28} {seconds:8.3f} {os.path.getsize(epub_path) / 1024:8.0f}  {checked}")
+        damaged = not sound
+        for level in args.levels:
+            for threads in args.threads:
+                convert_fixed_epub.zip_level, convert_fixed_epub.zip_threads = level, threads
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    seconds = time_packing(lambda: convert_fixed_epub.zip_folder_to_epub(folder_path, epub_path), args.repeat)
+                checked, sound = check_epub(epub_path)
+                print(f"{f'by type, level {level}, {threads} threads':28} {seconds:8.3f} {os.path.getsize(epub_path) / 1024:8.0f}  {checked}")
+                damaged = damaged or not sound
+
+    if damaged:
+        print("A packed epub has a damaged member")
+        sys.exit(1)
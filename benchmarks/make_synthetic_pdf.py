@@ -0,0 +1,105 @@
+'''
+Synthetic test pdf
+
+Generates an InDesign-like pdf for the benchmarks: the first page is a cover, every other page has one full-page background image
+(flattened artwork, as the converter expects) with positioned text spans on top. A cover jpg is written next to the pdf.
+
+python benchmarks/make_synthetic_pdf.py out/book.pdf --pages 50 --image-width 1800 --image-height 2400 --colorspace cmyk --spans 120 --fonts 4
+python benchmarks/make_synthetic_pdf.py out/book.pdf --photo    (grainy backgrounds whose jpegs don't deflate, like photos)
+'''
+
+import argparse
+import io
+import os
+import random
+
+### Contents
+# make_background
+# make_synthetic_pdf
+
+# base-14 fonts, so the pdf needs no font files
+FONT_NAMES = ("tiro", "tibo", "tiit", "tibi", "helv", "hebo", "heit", "hebi", "cour", "cobo", "coit", "cobi", "symb", "zadb")
+
+WORDS = "the quick brown fox jumps over a lazy dog while seven WIZARDS box and 12 jugs of liquor & more".split()
+
+def make_background(width, height, colorspace, page_num, quality=85, photo=False):
+    """
+    A jpeg background with some structure (blocks and a gradient) so the encoders have real work to do.
+    The smooth version deflates to a third like flat art, photo adds grain so it is as incompressible as a photo's jpeg.
+    """
+    from PIL import Image, ImageDraw, ImageChops
+
+    randomizer = random.Random(page_num)
+    mode = "CMYK" if colorspace == "cmyk" else "RGB"
+    image = Image.linear_gradient("L").resize((width, height))
+    if photo:
+        image = ImageChops.add(image, Image.effect_noise((width, height), 40), scale=1.5)
+    image = image.convert(mode)
+    draw = ImageDraw.Draw(image)
+    for _ in range(60):
+        left, top = randomizer.randrange(width), randomizer.randrange(height)
+        size = randomizer.randrange(20, max(21, width // 4))
+        color = tuple(randomizer.randrange(256) for _ in mode)
+        draw.rectangle((left, top, left + size, top + size // 2), fill=color)
+
+    data = io.BytesIO()
+    image.save(data, "JPEG", quality=quality)
+    return data.getvalue()
+
+def make_synthetic_pdf(pdf_path, pages=20, image_width=1200, image_height=1600, colorspace="rgb", spans=60, fonts=2, seed=1, photo=False):
+    """Writes the pdf and a cover.jpg beside it. Returns the cover path."""
+    import pymupdf
+
+    randomizer = random.Random(seed)
+    fonts_used = [pymupdf.Font(font_name) for font_name in FONT_NAMES[:max(1, min(fonts, len(FONT_NAMES)))]]
+    colors = ((0, 0, 0), (0.6, 0, 0), (0, 0, 0.5))
+    doc = pymupdf.open()
+
+    for page_num in range(pages):
+        page = doc.new_page(width=612, height=792)
+        page.insert_image(page.rect, stream=make_background(image_width, image_height, colorspace, page_num, photo=photo))
+        if page_num == 0:
+            continue
+
+        # spans in lines of a few words, changing font, size and colour now and then like styled InDesign text.
+        # One text writer per colour, so the page gets a single content stream update per colour.
+        writers = [pymupdf.TextWriter(page.rect) for _ in colors]
+        x, y = 54, 72
+        for span_num in range(spans):
+            text = " ".join(randomizer.choice(WORDS) for _ in range(randomizer.randrange(1, 5))) + " "
+            font = fonts_used[span_num % len(fonts_used)]
+            size = randomizer.choice((9, 10, 11, 14))
+            writers[randomizer.randrange(len(colors))].append((x, y), text, font=font, fontsize=size)
+            x += font.text_length(text, fontsize=size)
+            if x > 500:
+                x, y = 54, y + 16
+                if y > 740:
+                    x, y = 54, 72
+        for writer, color in zip(writers, colors):
+            writer.write_text(page, color=color)
+
+    doc.set_toc([[1, "Cover", 1], [1, "Chapter One", min(2, pages)]])
+    doc.save(pdf_path, garbage=3, deflate=True)
+    doc.close()
+
+    cover_path = os.path.join(os.path.dirname(os.path.abspath(pdf_path)), "cover.jpg")
+    with open(cover_path, "wb") as f:
+        f.write(make_background(600, 800, "rgb", 0, photo=photo))
+    return cover_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate an InDesign-like pdf for the benchmarks")
+    parser.add_argument("pdf_path")
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--image-width", type=int, default=1200)
+    parser.add_argument("--image-height", type=int, default=1600)
+    parser.add_argument("--colorspace", choices=["rgb", "cmyk"], default="rgb")
+    parser.add_argument("--spans", type=int, default=60, help="Text spans per page")
+    parser.add_argument("--fonts", type=int, default=2, help="Number of different fonts (up to 14)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--photo", action="store_true", help="Grainy backgrounds that compress like photos")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.pdf_path)), exist_ok=True)
+    make_synthetic_pdf(args.pdf_path, args.pages, args.image_width, args.image_height, args.colorspace, args.spans, args.fonts, args.seed, args.photo)
+    print(f"Written {args.pdf_path}")
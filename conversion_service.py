@@ -0,0 +1,353 @@
+'''
+Conversion service
+
+A local HTTP service around the converter, for systems that trigger conversions themselves (e.g. a metadata system).
+Jobs are queued onto a fixed pool of warm worker processes, so the import cost is paid once per worker and no more books run at once than there are workers.
+
+python3 conversion_service.py [--port 8765] [--workers 2] [--max-queue 20] [--jobs-folder conversion_jobs]
+
+POST /jobs              queue a conversion (json, see below). Returns 202 with the job id, or the epub itself with "wait": true
+GET  /jobs              all jobs
+GET  /jobs/<id>         status and timings of one job
+GET  /jobs/<id>/epub    the finished epub
+GET  /jobs/<id>/log     the conversion output
+GET  /status            workers, queue depth and job counts
+
+The job json gives the pdf and cover either as paths on this machine or uploaded as base64:
+    {"pdf": "/books/9781234567890.pdf", "cover": "/books/9781234567890.jpg",
+     "metadata": {"title": "...", "author": "...", "isbn": "..."}, "options": {"subset_fonts": true}}
+    {"pdf_data": "<base64>", "cover_data": "<base64>", "fonts": {"Font-Regular.otf": "<base64>"}, "metadata": {...}}
+Fonts are read from "font_folder", the uploaded "fonts" or the "fonts" folder next to the pdf.
+
+The service only listens on localhost by default. It has no authentication, don't expose it to a network.
+'''
+
+import os
+import io
+import json
+import time
+import uuid
+import queue
+import shutil
+import base64
+import argparse
+import threading
+import contextlib
+import traceback
+from dataclasses import fields
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from converter import Converter, BookMetadata, ConversionOptions
+
+### Contents
+# warm_up_worker
+# run_job
+# ConversionService
+# ServiceRequestHandler
+# make_server
+
+METADATA_FIELDS = {field.name for field in fields(BookMetadata)}
+OPTION_FIELDS = {field.name for field in fields(ConversionOptions)}
+
+# job details returned by the api (the job's future and paths stay internal)
+JOB_FIELDS = ("id", "status", "submitted_at", "queue_seconds", "convert_seconds", "total_seconds", "pages", "epub_bytes", "error")
+
+def warm_up_worker():
+    # Worker process initializer: import the converter and its libraries before the first job arrives
+    Converter().load()
+
+def run_job(job_folder, pdf_path, cover_path, metadata, options, font_folder):
+    """
+    Converts one job in a worker process. Never raises: errors are returned in the result.
+    The epub is written to <job folder>/book.epub and the conversion output to <job folder>/convert.log.
+    """
+    started_at = time.time()
+    start = time.perf_counter()
+    result = {"started_at": started_at, "error": None}
+    log_path = os.path.join(job_folder, "convert.log")
+
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        try:
+            with contextlib.redirect_stdout(log_file):
+                converted = Converter(options).convert(pdf_path, cover_path, metadata, os.path.join(job_folder, "book.epub"), font_folder)
+            result["pages"] = converted["pages"]
+            result["epub_bytes"] = converted["epub_bytes"]
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            log_file.write(traceback.format_exc())
+
+    result["convert_seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+class ConversionService:
+    """
+    The job queue: jobs wait in a bounded queue and a dispatcher thread hands them to a pool of warm worker processes as workers come free.
+
+    At most workers jobs convert at once; up to max_queue more wait their turn and further jobs are refused until there is room.
+    Status and timings of every job are kept in memory. If a worker process dies (e.g. a crash inside MuPDF) the pool is replaced and the jobs it was
+    running are run again, each in a pool of its own, so only the job that crashes again fails.
+    """
+
+    def __init__(self, jobs_folder, workers=2, max_queue=20):
+        self.jobs_folder = os.path.abspath(jobs_folder)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.waiting = queue.Queue(maxsize=max_queue)
+        # one slot per worker, so a job only leaves the queue when a worker can start it
+        self.free_workers = threading.Semaphore(workers)
+        os.makedirs(self.jobs_folder, exist_ok=True)
+        self.executor = self._start_pool()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def _start_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up_worker)
+
+    def submit(self, request):
+        """Validates and queues a job request. Returns the job, raises ValueError for a bad request and OverflowError when the queue is full."""
+        metadata = request.get("metadata") or {}
+        options = request.get("options") or {}
+        unknown = (set(metadata) - METADATA_FIELDS) | (set(options) - OPTION_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown metadata or options: {', '.join(sorted(unknown))}")
+        if self.waiting.full():
+            raise OverflowError(f"Queue is full ({self.max_queue} jobs waiting)")
+
+        job_id = uuid.uuid4().hex[:12]
+        job_folder = os.path.join(self.jobs_folder, job_id)
+        os.makedirs(job_folder)
+        try:
+            pdf_path, cover_path, font_folder = self._job_files(request, job_folder)
+        except (ValueError, OSError):
+            shutil.rmtree(job_folder, ignore_errors=True)
+            raise
+
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "submitted_at": time.time(),
+            "queue_seconds": None,
+            "convert_seconds": None,
+            "total_seconds": None,
+            "pages": None,
+            "epub_bytes": None,
+            "error": None,
+            "folder": job_folder,
+            "arguments": (job_folder, pdf_path, cover_path, metadata, options, font_folder),
+            "done": threading.Event(),
+            # the pool running the job, and whether it is being run again after a worker died
+            "executor": None,
+            "retried": False,
+        }
+        try:
+            self.waiting.put_nowait(job)
+        except queue.Full:
+            shutil.rmtree(job_folder, ignore_errors=True)
+            raise OverflowError(f"Queue is full ({self.max_queue} jobs waiting)")
+        with self.lock:
+            self.jobs[job_id] = job
+        return job
+
+    def _job_files(self, request, job_folder):
+        # Uploaded files are written to the job folder, paths are used where they are
+        files = {}
+        for name, file_name in (("pdf", "book.pdf"), ("cover", "cover.jpg")):
+            if request.get(f"{name}_data"):
+                files[name] = os.path.join(job_folder, file_name)
+                with open(files[name], "wb") as f:
+                    f.write(base64.b64decode(request[f"{name}_data"]))
+            elif request.get(name):
+                files[name] = os.path.abspath(request[name])
+                if not os.path.isfile(files[name]):
+                    raise ValueError(f"{name} not found: {request[name]}")
+            else:
+                raise ValueError(f"Give {name} (a path) or {name}_data (base64)")
+
+        font_folder = request.get("font_folder")
+        if request.get("fonts"):
+            font_folder = os.path.join(job_folder, "fonts")
+            os.makedirs(font_folder)
+            for font_name, font_data in request["fonts"].items():
+                with open(os.path.join(font_folder, os.path.basename(font_name)), "wb") as f:
+                    f.write(base64.b64decode(font_data))
+        elif not font_folder:
+            font_folder = os.path.join(os.path.dirname(files["pdf"]), "fonts")
+
+        return files["pdf"], files["cover"], font_folder
+
+    def _dispatch(self):
+        # Hands queued jobs to the pool one free worker at a time, until shutdown() queues None
+        while True:
+            self.free_workers.acquire()
+            job = self.waiting.get()
+            if job is None:
+                return
+            with self.lock:
+                job["status"] = "running"
+            executor = self.executor
+            try:
+                self._run(job, executor)
+            except BrokenProcessPool:
+                self._replace_pool(executor)
+                self._run(job, self.executor)
+
+    def _run(self, job, executor):
+        # Starts the job on executor, _finish is called when it ends
+        future = executor.submit(run_job, *job["arguments"])
+        job["executor"] = executor
+        future.add_done_callback(lambda future, job=job: self._finish(job, future))
+
+    def _replace_pool(self, broken):
+        # Every job that was running sees the same broken pool, only the first one replaces it
+        with self.lock:
+            if self.executor is broken:
+                self.executor = self._start_pool()
+                broken.shutdown(wait=False)
+
+    def _finish(self, job, future):
+        finished_at = time.time()
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            if not job["retried"]:
+                # A worker died and took every job in the pool with it. Run this one again on its own, so a crash
+                # only fails the job that causes it. The job keeps its worker slot meanwhile
+                job["retried"] = True
+                self._replace_pool(job["executor"])
+                self._run(job, ProcessPoolExecutor(max_workers=1, initializer=warm_up_worker))
+                return
+            result = {"started_at": None, "error": "The worker process died converting this book (e.g. a crash inside MuPDF)"}
+        except Exception as e:
+            result = {"started_at": None, "error": f"{type(e).__name__}: {e}"}
+        if job["retried"]:
+            job["executor"].shutdown(wait=False)
+
+        with self.lock:
+            job.update({key: value for key, value in result.items() if key != "started_at"})
+            job["status"] = "failed" if result["error"] else "done"
+            if result["started_at"]:
+                job["queue_seconds"] = round(result["started_at"] - job["submitted_at"], 3)
+            job["total_seconds"] = round(finished_at - job["submitted_at"], 3)
+        self.free_workers.release()
+        job["done"].set()
+
+    def job_status(self, job):
+        """The job's api details."""
+        return {name: job[name] for name in JOB_FIELDS}
+
+    def status(self):
+        with self.lock:
+            statuses = [job["status"] for job in self.jobs.values()]
+            finished = [job for job in self.jobs.values() if job["status"] in ("done", "failed")]
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queue_depth": self.waiting.qsize(),
+            "running": statuses.count("running"),
+            "done": statuses.count("done"),
+            "failed": statuses.count("failed"),
+            "average_convert_seconds": round(sum(job["convert_seconds"] or 0 for job in finished) / len(finished), 3) if finished else None,
+        }
+
+    def shutdown(self):
+        """Stops taking jobs from the queue and waits for the running ones."""
+        # make sure the dispatcher can take the sentinel even when every worker is busy
+        self.free_workers.release()
+        self.waiting.put(None)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    # set by make_server
+    service = None
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_json(404, {"error": "Not found"})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            job = self.service.submit(request)
+        except OverflowError as e:
+            return self._send_json(503, {"error": str(e)})
+        except (ValueError, TypeError, OSError) as e:
+            return self._send_json(400, {"error": str(e)})
+
+        if not request.get("wait"):
+            return self._send_json(202, self.service.job_status(job))
+
+        job["done"].wait()
+        if job["status"] == "done":
+            return self._send_file(os.path.join(job["folder"], "book.epub"), "application/epub+zip", job["id"])
+        return self._send_json(500, self.service.job_status(job))
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+
+        if parts == ["status"]:
+            return self._send_json(200, self.service.status())
+        if parts == ["jobs"]:
+            return self._send_json(200, [self.service.job_status(job) for job in list(self.service.jobs.values())])
+        if len(parts) < 2 or parts[0] != "jobs" or parts[1] not in self.service.jobs:
+            return self._send_json(404, {"error": "Not found"})
+
+        job = self.service.jobs[parts[1]]
+        if len(parts) == 2:
+            return self._send_json(200, self.service.job_status(job))
+        if parts[2:] == ["epub"]:
+            if job["status"] != "done":
+                return self._send_json(409, self.service.job_status(job))
+            return self._send_file(os.path.join(job["folder"], "book.epub"), "application/epub+zip", job["id"])
+        if parts[2:] == ["log"]:
+            return self._send_file(os.path.join(job["folder"], "convert.log"), "text/plain; charset=utf-8")
+        return self._send_json(404, {"error": "Not found"})
+
+    def _send_json(self, code, data):
+        body = json.dumps(data, indent=4).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, file_path, content_type, job_id=None):
+        if not os.path.exists(file_path):
+            return self._send_json(404, {"error": "Not found"})
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(os.path.getsize(file_path)))
+        if job_id:
+            self.send_header("X-Job-Id", job_id)
+        self.end_headers()
+        with open(file_path, "rb") as f:
+            while chunk := f.read(io.DEFAULT_BUFFER_SIZE * 16):
+                self.wfile.write(chunk)
+
+def make_server(host="127.0.0.1", port=8765, workers=2, max_queue=20, jobs_folder="conversion_jobs"):
+    """Creates the service and its HTTP server (port 0 picks a free port). Call serve_forever() on it, and server.service.shutdown() when done."""
+    service = ConversionService(jobs_folder, workers, max_queue)
+    handler = type("Handler", (ServiceRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.service = service
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local HTTP service that converts pdfs to fixed-layout epubs on a pool of warm workers")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (localhost by default, the service has no authentication)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes, i.e. books converted at the same time")
+    parser.add_argument("--max-queue", type=int, default=20, help="Jobs that can wait for a worker before new jobs are refused (503)")
+    parser.add_argument("--jobs-folder", default="conversion_jobs", help="Where uploaded files, epubs and logs are kept per job")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.workers, args.max_queue, args.jobs_folder)
+    print(f"Conversion service on http://{args.host}:{server.server_address[1]} with {args.workers} workers, jobs in {server.service.jobs_folder}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.service.shutdown()
@@ -10,46 +10,84 @@ It also assumes that the first page is the cover.
 The first run will generate a list of fonts. Ensure those fonts are in a folder named "fonts" in the same directory as the pdf. Then run it again.
 """
 
-from functions import get_input_file, extract_pdf_to_json
+from functions import get_input_file, page_to_json_line, merge_line_spans
+from epub_writer import EpubWriter
+from page_cache import PageCache, font_folder_fingerprint
+from page_context import PageContext
+from run_stats import PageStats, RunStats, save_report, merge_page_stats
+from jpeg_encoder import JpegEncoder
+from image_format import IMAGE_FORMATS, encode_smallest, get_media_type
+from memory_guard import MemoryGuard, MemoryScheduler, LineSpool, current_rss_mb, private_rss_mb
 from datetime import datetime
 import os
 import html
-import zipfile
-import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pymupdf #  PDF processing
-from PIL import Image # pillow package
 import io
-from datetime import datetime
-from titlecase import titlecase
+import time
+import hashlib
+import re
+import queue
+import threading
+# PIL (pillow) and titlecase are imported where they are used so importing this module stays quick
 
 ## Function list
 # int_to_hex_color
 # convert_allcaps
 # generate_font_list
 # 
-# write_mimetype_file
 # write_meta_inf_container_xml
 # write_content_opf
 # write_toc_xhtml
 # write_toc_ncx
 # write_css_and_font_files
+# get_used_fonts
+# subset_font
 # 
+# convert_book
 # create_epub_structure_from_pdf
+# print_run_stats
+# split_page_ranges
+# split_page_ranges_by_cost
+# map_in_window
+# run_page_pipeline
+# convert_page_range
+# convert_pages
+# get_worker_options
+# set_worker_options
+# get_page_options
+# convert_page
+# finish_page_result
+# get_page_title
+# relabel_page_html
 # generate_html
+# generate_text_run
+# get_text_color
+# get_text_style
+# get_style_class
+# minify_xhtml
+# get_image_target_size
+# get_image_budget_bytes
+# get_jpeg_encoder
+# get_jpeg_passthrough
+# pixmap_to_image
+# get_image_name
+# rename_image
+# encode_page_image
+# decode_page_image
+# finish_page_image
+# downscale_cover_image
+# get_stream_length
+# get_image_components
+# estimate_page_memory_mb
 # process_images
+# scan_font_range
+# format_page_list
+# scan_fonts
 # zip_folder_to_epub
 
 
-# Get pdf file
-pdf_path = get_input_file('pdf')
-
-# Set base path and change directory
-current_folder = os.path.dirname(pdf_path)
-os.chdir(current_folder)
-
-# Get cover image
-cover_image = get_input_file('jpeg')
-
 #set date
 current_date = datetime.now().strftime('%Y-%m-%d')
 
@@ -66,16 +104,89 @@ isbn =  "9780000000000"
 # Options
 #  set page_start_left for page 1 to start recto (False) or verso (True)
 page_start_left = False
-# set to True to export raw json
+# set to True to export raw json (one line per page), json_images is "omit", "hash" or "base64"
 export_json = False
+json_images = "hash"
+json_compact = False
+# number of worker processes used to convert pages (1 converts in this process)
+workers = 1
+# set to a PageCache to reuse unchanged pages from earlier runs
+page_cache = None
+# set to True to cut the fonts down to the characters used in the PDF (needs fontTools)
+subset_fonts = False
+# join spans on the same line into one element when they are within merge_tolerance px of each other
+merge_spans = True
+merge_tolerance = 2.0
+# set to False to write font, size and colour inline on every text element instead of css classes
+style_classes = True
+# set to True to strip the whitespace between tags and the img styles the css already sets
+minify_html = False
+# set to False to skip the json report of stage times and counts (<name>_report.json)
+write_report = True
+# set to True to keep memory flat on very long pdfs (releases MuPDF's memory every few pages, measures peak memory per stage)
+low_memory = False
+# memory (MB) the conversion should stay under, turns on low-memory mode. With workers, pages are only started while their estimated
+# memory fits in it, otherwise the process releases everything it can once it goes over it
+memory_budget_mb = None
+# set in worker processes, which keep their share of memory_budget_mb by the memory they don't share with this process
+in_worker_process = False
+# background images bigger than this are resampled before encoding: longest side in pixels, and/or a multiple of the page size
+# (the viewport / original-resolution, e.g. 2 for a 612x792 page gives at least 1224x1584). None keeps the embedded resolution
+max_image_size = None
+image_scale = None
+# set to True to apply the same limits to the external cover image
+downscale_cover = False
+# jpeg settings for re-encoded background images (see JpegEncoder), subsampling "4:4:4", "4:2:2", "4:2:0" or None for Pillow's choice
+jpeg_quality = 75
+jpeg_min_quality = 30
+jpeg_progressive = False
+jpeg_optimize = False
+jpeg_subsampling = None
+# size limits for the background images: per image (KB), and for all of them plus the cover (MB), shared out evenly per distinct image.
+# An image over its limit is re-encoded at the highest quality from jpeg_quality down to jpeg_min_quality that fits
+image_max_kb = None
+book_images_max_mb = None
+# formats re-encoded background images may be written in (jpeg, png, webp). With more than jpeg each image is analysed and written in the
+# smallest suitable one: flat colour art as palette png or lossless webp, photos as jpeg or lossy webp. Leave webp out for older readers
+image_formats = ("jpeg",)
+# threads that encode the background images while the next pages are extracted and the finished ones are zipped (only without workers).
+# 0 runs the stages one after another
+pipeline_threads = 0
+# zlib level (0-9) of the epub's text and font members, None for zlib's default (6). Images are stored as they are, they are compressed already
+zip_level = None
+# threads that deflate the text members while the conversion goes on, 0 deflates them as they are written
+zip_threads = 0
+
+# metadata and options convert_book can set per book, and their defaults
+BOOK_SETTINGS = (
+    "title", "author", "language", "publisher", "date", "description", "rights", "isbn",
+    "page_start_left", "export_json", "json_images", "json_compact", "workers",
+    "subset_fonts", "merge_spans", "merge_tolerance", "style_classes", "minify_html", "write_report",
+    "low_memory", "memory_budget_mb", "max_image_size", "image_scale", "downscale_cover",
+    "jpeg_quality", "jpeg_min_quality", "jpeg_progressive", "jpeg_optimize", "jpeg_subsampling", "image_max_kb", "book_images_max_mb",
+    "image_formats", "pipeline_threads", "zip_level", "zip_threads",
+)
+BOOK_DEFAULTS = {name: globals()[name] for name in BOOK_SETTINGS}
 
-# set file paths
-epub_file_name =  os.path.splitext(pdf_path)[0]
-output_folder_html = os.path.join(epub_file_name + "_html")
-epub_file_path = os.path.join(epub_file_name + ".epub")
-font_folder = current_folder + "/fonts"
 css_folder = "css"
 
+# fonts found while generating the pages
+fonts_in_pdf = []
+# characters used per font, for font subsetting
+font_codepoints = {}
+# css class name -> font/size/colour rule, written once into style.css
+text_styles = {}
+# image file names by (pdf, xref, size), so shared images are only encoded once per process
+image_names = {}
+# byte limit for each background image in this run, from image_max_kb and book_images_max_mb
+image_budget_bytes = None
+# longest page range a worker converts in one go in low-memory mode
+LOW_MEMORY_RANGE_PAGES = 10
+# estimated memory (MB) of a page's text and html, on top of its background image
+PAGE_MEMORY_MB = 2
+# pages that can wait between the stages of a pipelined run, which bounds the decoded images held at once
+PIPELINE_DEPTH = 4
+
 def int_to_hex_color(value):
     return f"#{value:06X}"
 
@@ -105,14 +216,8 @@ def generate_font_list(folder_path):
     return font_array
 
 # create base files
-def write_mimetype_file(output_folder):
-    mimetype_path = os.path.join(output_folder, "mimetype")
-    with open(mimetype_path, "w", encoding="utf-8") as f:
-        f.write("application/epub+zip")
-
-def write_meta_inf_container_xml(meta_inf_folder):
+def write_meta_inf_container_xml(writer):
     """Write the META-INF/container.xml file"""
-    container_path = os.path.join(meta_inf_folder, "container.xml")
     container_content = """<?xml version="1.0" encoding="UTF-8"?>
 <container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
     <rootfiles>
@@ -120,17 +225,15 @@ def write_meta_inf_container_xml(meta_inf_folder):
     </rootfiles>
 </container>
 """
-    with open(container_path, "w", encoding="utf-8") as f:
-        f.write(container_content)
+    writer.writestr("META-INF/container.xml", container_content)
 
-def write_content_opf(oebps_folder,content_opf_items,xhtml_files,page):
+def write_content_opf(writer,content_opf_items,xhtml_files,page):
     page_width = int(page.rect.width)
     page_height = int(page.rect.height)
     """Write OEBPS/content.opf"""
-    content_opf_path = os.path.join(oebps_folder, "content.opf")
 
     font_items = ""
-    for font in font_list:        
+    for font in get_used_fonts():        
         media_type = "application/x-font-ttf"  # Default for .ttf
         font_path=os.path.basename(font["font_path"])
         if font_path.lower().endswith(".otf"):
@@ -188,12 +291,11 @@ def write_content_opf(oebps_folder,content_opf_items,xhtml_files,page):
     </spine>
 </package>
 """
-    with open(content_opf_path, "w", encoding="utf-8") as f:
-        f.write(content_opf_content)
+    writer.writestr("OEBPS/content.opf", content_opf_content)
 
-def write_toc_xhtml(oebps_folder, doc):
+def write_toc_xhtml(writer, doc):
     """Generates nav.xhtml Table of Contents. Will add Bookmarks if they are included in the pdf."""
-    toc_xhtml_path = os.path.join(oebps_folder, "nav.xhtml")
+    from titlecase import titlecase
     toc = doc.get_toc() 
     toc_xhtml_points = []
     # for chapnum, t in enumerate(toc) :
@@ -239,20 +341,16 @@ def write_toc_xhtml(oebps_folder, doc):
     </body>
 </html>
 """
-    with open(toc_xhtml_path, "w", encoding="utf-8") as f:
-        f.write(toc_xhtml_content)
+    writer.writestr("OEBPS/nav.xhtml", toc_xhtml_content)
 
-def write_css_and_font_files(oebps_folder,font_folder_output,page):
+def write_css_and_font_files(writer,page):
 
     page_width = int(page.rect.width)
     page_height = int(page.rect.height)
         # Step 8: Add a CSS file with @font-face
-    css_folder = os.path.join(oebps_folder, "css")
-    os.makedirs(css_folder, exist_ok=True)  # Create the 'css' folder if it doesn't exist
-    css_path = os.path.join(css_folder, "style.css")
     css_content = ""
 
-    for font in font_list :
+    for font in get_used_fonts() :
         original_extension = os.path.splitext(font['font_path'])[1]
         output_filename_css = f"{font['font_name']}{original_extension}" # Path in CSS
         css_content += f"""@font-face {{
@@ -301,108 +399,285 @@ strong {{
 	text-transform:uppercase;
 }}
 """
-    with open(css_path, "w", encoding="utf-8") as f:
-        f.write(css_content)
 
-    for font in font_list : 
+    # Text styles used in the book
+    for style_class, text_style in text_styles.items():
+        css_content += f".{style_class} {{ {text_style} }}\n"
+    writer.writestr(f"OEBPS/{css_folder}/style.css", css_content)
+
+    for font in font_list:
+        if font not in get_used_fonts():
+            print(f"Font not used in the PDF, left out: {os.path.basename(font['font_path'])}")
+
+    for font in get_used_fonts() : 
         original_extension = os.path.splitext(font['font_path'])[1]  # Get the original extension (.ttf or .otf)
         output_filename = f"{font['font_name']}{original_extension}"
-        font_path_output = os.path.join(font_folder_output, output_filename)
-        shutil.copyfile(font['font_path'], font_path_output)
 
-# Start process
-def create_epub_structure_from_pdf(pdf_path, output_folder, page_start_left, export_json):    
-    #Create the folder structure and files needed for epub.
-    os.makedirs(output_folder, exist_ok=True)
-    
-    meta_inf_folder = os.path.join(output_folder, "META-INF")
-    os.makedirs(meta_inf_folder, exist_ok=True)
-    
-    oebps_folder = os.path.join(output_folder, "OEBPS")
-    os.makedirs(oebps_folder, exist_ok=True)
+        if subset_fonts:
+            font_data = subset_font(font['font_path'], font_codepoints.get(font['font_name'], ""))
+            if font_data is not None:
+                original_size = os.path.getsize(font['font_path'])
+                saved = original_size - len(font_data)
+                print(f"Subset {output_filename}: {original_size:,} -> {len(font_data):,} bytes ({saved:,} saved, {100 * saved / original_size:.0f}%)")
+                writer.writestr(f"OEBPS/font/{output_filename}", font_data)
+                continue
 
-    font_folder_output = os.path.join(oebps_folder, "font")
-    os.makedirs(font_folder_output, exist_ok=True)
+        writer.write(font['font_path'], f"OEBPS/font/{output_filename}")
 
-    images_folder = os.path.join(oebps_folder, "image")
-    os.makedirs(images_folder, exist_ok=True)
-    
-    write_mimetype_file(output_folder)
-    write_meta_inf_container_xml(meta_inf_folder)
+def get_used_fonts():
+    """The fonts in the fonts folder that the PDF actually uses."""
+    return [font for font in font_list if font["font_name"] in fonts_in_pdf]
+
+def subset_font(font_path, characters):
+    """
+    Returns the font cut down to the glyphs for the given characters, or None if fontTools is not installed or cannot read the font.
+    Layout features are kept so kerning and ligatures still work on the remaining glyphs.
+    """
+    try:
+        from fontTools import subset
+        from fontTools.ttLib import TTFont
+    except ImportError:
+        print("fontTools is not installed (pip3 install fonttools), copying fonts at full size.")
+        return None
+
+    options = subset.Options()
+    options.layout_features = ["*"]
+    options.name_IDs = ["*"]
+    options.name_languages = ["*"]
+    options.notdef_outline = True
+
+    try:
+        font = TTFont(font_path)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=[ord(char) for char in characters])
+        subsetter.subset(font)
+        font_data = io.BytesIO()
+        font.save(font_data)
+        font.close()
+    except Exception as e:
+        print(f"Could not subset {os.path.basename(font_path)} ({e}), copying it at full size.")
+        return None
+
+    return font_data.getvalue()
+
+def convert_book(pdf_path, cover_image_path, metadata=None, options=None, epub_path=None, font_folder=None, output_folder=None, cache_folder=None, cache_size_mb=1024):
+    """
+    Converts one book without any prompts, for batch runs and the Converter API. By default the epub is written next to the pdf and the fonts are read from the "fonts" folder beside it.
+    metadata (title, author, isbn, ...) and options (subset_fonts, minify_html, ...) override the defaults at the top of this file for this book only.
+    output_folder also keeps the exploded epub, cache_folder keeps converted pages so reruns only convert the pages that changed.
+    Returns the epub path, page count and size.
+    """
+    global cover_image, font_list, page_cache
+
+    settings = dict(metadata or {})
+    settings.update(options or {})
+    unknown = set(settings) - set(BOOK_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown metadata or options: {', '.join(sorted(unknown))}")
+
+    # Start every book from the defaults, a worker process may have converted another book before
+    globals().update(BOOK_DEFAULTS)
+    globals().update(settings)
+    fonts_in_pdf.clear()
+    font_codepoints.clear()
+    text_styles.clear()
+    image_names.clear()
+
+    cover_image = cover_image_path
+    font_folder = font_folder or os.path.join(os.path.dirname(os.path.abspath(pdf_path)), "fonts")
+    font_list = generate_font_list(font_folder) if os.path.isdir(font_folder) else []
+    page_cache = PageCache(cache_folder, cache_size_mb * 1024 * 1024, font_folder_fingerprint(font_list)) if cache_folder else None
+    epub_path = epub_path or os.path.splitext(pdf_path)[0] + ".epub"
+
+    page_count = create_epub_structure_from_pdf(pdf_path, epub_path, page_start_left, export_json, output_folder)
+
+    return {
+        "epub_path": epub_path,
+        "pages": page_count,
+        "epub_bytes": os.path.getsize(epub_path),
+    }
 
-    # Initialize content.opf and toc.ncx content
-    content_opf_items = []
-    xhtml_files = []
+# Start process
+def create_epub_structure_from_pdf(pdf_path, epub_path, page_start_left, export_json, output_folder=None):    
+    #Write the files needed for epub straight into the epub archive. Pass output_folder to also keep an exploded copy for debugging.
+    global image_budget_bytes, low_memory
+    # The memory budget is kept by low-memory mode, whether it was set on the command line or through convert_book
+    low_memory = low_memory or bool(memory_budget_mb)
+    run_stats = RunStats(track_memory=low_memory)
+    writer = EpubWriter(epub_path, output_folder, zip_level, zip_threads)
+    write_meta_inf_container_xml(writer)
+
+    # Initialize content.opf and toc.ncx content, in low-memory mode they go to a temporary file once they grow
+    content_opf_items = LineSpool() if low_memory else []
+    xhtml_files = LineSpool() if low_memory else []
 
     # Loop through PDF pages and generate HTML
     doc = pymupdf.open(pdf_path)
-
-    # Optional generate json for development purposes
+    page_count = doc.page_count
+    image_budget_bytes = get_image_budget_bytes(doc, cover_image)
+    if image_budget_bytes:
+        print(f"Background images are kept under {image_budget_bytes / 1024:.0f} KB each")
+    page_costs = None
+    if memory_budget_mb and workers > 1:
+        page_costs = [estimate_page_memory_mb(doc, page_num) for page_num in range(page_count)]
+    if low_memory:
+        # The page loop opens the pdf itself, it is reopened for the toc and page size afterwards
+        doc.close()
+
+    # Optional generate json for development purposes, written from the same page extraction as the html
+    json_file = None
     if export_json : 
         print("Extracting the PDF structure as raw JSON data for verification")
-        extract_pdf_to_json(
-            doc,
-            os.path.join(output_folder, epub_file_name + "_rawstructure.json")
-        )
+        json_path = os.path.splitext(epub_path)[0] + "_rawstructure.ndjson"
+        json_file = open(json_path, "w", encoding="utf-8")
 
-    image_counter = 0
     print("Processing pages: ")
 
-    for page_num in range(doc.page_count):
-        page = doc.load_page(page_num)
-
-        if page_num == 0:
-            page_name ="cover"  # First page as cover
-            page_label ="i"  # First page as Roman numeral (cover)
+    # Convert the pages, either here or spread over worker processes
+    executor = None
+    scheduler = None
+    if workers > 1:
+        print(f"Using {workers} worker processes")
+        worker_options = get_worker_options()
+        if memory_budget_mb:
+            # Each worker keeps to its share of the budget, releasing MuPDF's memory when it goes over it
+            worker_options["memory_budget_mb"] = max(1, round(memory_budget_mb / workers))
+            worker_options["in_worker_process"] = True
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=set_worker_options, initargs=(worker_options,))
+        if page_costs:
+            # At rest the processes hold what this one holds plus what each worker adds of its own once started (a forked
+            # worker's copy-on-write pages are this process's). As many pages run at once as the budget then allows:
+            # heavy pages get ranges of their own and run with fewer others
+            worker_mb = max(future.result() for future in [executor.submit(private_rss_mb) for _ in range(workers)])
+            page_ranges = split_page_ranges_by_cost(page_costs, LOW_MEMORY_RANGE_PAGES)
+            scheduler = MemoryScheduler(executor, memory_budget_mb, workers, current_rss_mb() + worker_mb * workers)
+            range_results = scheduler.map(convert_page_range,
+                [(pdf_path, page_range, cover_image, page_cache) for page_range in page_ranges],
+                [max(page_costs[start:stop]) for start, stop in page_ranges],
+                [f"page {start}" if stop - start == 1 else f"pages {start}-{stop - 1}" for start, stop in page_ranges])
+        elif low_memory:
+            # Small ranges and only a few in flight, so finished pages can't pile up here while an earlier range is still converting
+            page_ranges = split_page_ranges(page_count, workers, max_pages=LOW_MEMORY_RANGE_PAGES)
+            range_results = map_in_window(executor, convert_page_range,
+                [(pdf_path, page_range, cover_image, page_cache) for page_range in page_ranges], workers * 2)
         else:
-            page_name =  "page_" + str(page_num)  # Start second page at 1 
-            page_label = str(page_num)  # Start second page at 1 
-
-        html_file_name = f"{page_name}.xhtml"
-        html_file_path = os.path.join(oebps_folder, html_file_name)
-
-        # Generate fixed-layout HTML for the page
-        page_html, image_counter, image_manifest = generate_html(
-            page, page_label, page_name, image_counter
-        )
-
-        with open(html_file_path, "w", encoding="utf-8") as f:
-            f.write(page_html)
-
-        # Add to manifest and toc
-        content_opf_items.append(
-            f'<item id="page_{page_num}" href="{html_file_name}" media-type="application/xhtml+xml"/>\n'
-        )
-        for img in image_manifest:
+            page_ranges = split_page_ranges(page_count, workers)
+            range_results = executor.map(
+                convert_page_range,
+                [pdf_path] * len(page_ranges),
+                page_ranges,
+                [cover_image] * len(page_ranges),
+                [page_cache] * len(page_ranges)
+            )
+        page_results = (result for results in range_results for result in results)
+    elif pipeline_threads:
+        print(f"Pipelined, encoding images on {pipeline_threads} {'thread' if pipeline_threads == 1 else 'threads'}")
+
+        def convert_pages_on(image_pool):
+            if low_memory:
+                return convert_pages(pdf_path, (0, page_count), cover_image, page_cache, image_pool)
+            return (convert_page(doc, page_num, cover_image, page_cache, image_pool) for page_num in range(page_count))
+
+        page_results = run_page_pipeline(convert_pages_on, pipeline_threads, PIPELINE_DEPTH, page_cache)
+    elif low_memory:
+        page_results = convert_pages(pdf_path, (0, page_count), cover_image, page_cache)
+    else:
+        page_results = (convert_page(doc, page_num, cover_image, page_cache) for page_num in range(page_count))
+
+    # Write and merge the page entries in page order as they arrive
+    written_members = set()
+    manifest_images = set()
+    cache_hits = 0
+    text_counts = {"spans": 0, "divs": 0, "inline_spans": 0}
+    pages_start = time.perf_counter()
+    try:
+        for result in page_results:
+            page_num = result["page_num"]
+            cache_hits += result["cache_hit"]
+            run_stats.add_page(result["stats"])
+            for count_name, count in result["counts"].items():
+                text_counts[count_name] += count
+
+            # Shared images can come back from more than one worker, keep the first copy
+            for arcname, data in result["members"]:
+                if arcname not in written_members:
+                    writer.writestr(arcname, data)
+                    written_members.add(arcname)
+
+            if json_file:
+                json_file.write(result["json_line"])
+
+            for font_name in result["fonts"]:
+                if font_name not in fonts_in_pdf:
+                    fonts_in_pdf.append(font_name)
+
+            text_styles.update(result["styles"])
+
+            for font_name, characters in result["codepoints"].items():
+                font_codepoints[font_name] = "".join(sorted(set(font_codepoints.get(font_name, "")) | set(characters)))
+
+            # Add to manifest and toc
             content_opf_items.append(
-                f'<item id="page_{img["id"]}" href="{img["href"]}" media-type="image/jpeg"/>\n'
+                f'<item id="page_{page_num}" href="{result["html_file_name"]}" media-type="application/xhtml+xml"/>\n'
             )
-
-        page_id = f"page_{page_num}"
-        is_odd_page = (page_num % 2 != 0)
-
-        if page_num == 0: # if cover start as right page
-            spread = "page-spread-right" 
-
-        else: 
-            if page_start_left:
-                spread = "page-spread-left" if is_odd_page else "page-spread-right"
-            else:
-                spread = "page-spread-right" if is_odd_page else "page-spread-left"
-
-        print(page_id, " | ", spread)
-        xhtml_files.append(f'<itemref idref="{page_id}" properties="{spread}"/>\n')
+            # Each distinct image is listed once, however many pages use it
+            for img in result["image_manifest"]:
+                if img["href"] not in manifest_images:
+                    manifest_images.add(img["href"])
+                    content_opf_items.append(
+                        f'<item id="{img["id"]}" href="{img["href"]}" media-type="{get_media_type(img["href"])}"/>\n'
+                    )
+
+            page_id = f"page_{page_num}"
+            is_odd_page = (page_num % 2 != 0)
+
+            if page_num == 0: # if cover start as right page
+                spread = "page-spread-right" 
+
+            else: 
+                if page_start_left:
+                    spread = "page-spread-left" if is_odd_page else "page-spread-right"
+                else:
+                    spread = "page-spread-right" if is_odd_page else "page-spread-left"
+
+            print(page_id, " | ", spread, *[f" | image {image_path}" for image_path in result["image_log"]])
+            xhtml_files.append(f'<itemref idref="{page_id}" properties="{spread}"/>\n')
+
+    finally:
+        # Stops a pipelined run's page thread if the loop failed
+        page_results.close()
+        if executor:
+            executor.shutdown()
+        if json_file:
+            json_file.close()
+            print(f"PDF content extracted and saved to {json_path}")
+        run_stats.seconds["pages"] = time.perf_counter() - pages_start
+
+    if scheduler:
+        run_stats.add("memory_holds", scheduler.throttled)
+        run_stats.add("most_running", scheduler.most_running)
+        print(f"Memory budget {memory_budget_mb} MB: estimated peak page {max(page_costs):.0f} MB, "
+              f"up to {scheduler.most_running} of {workers} workers at once, held back {scheduler.throttled} times")
+
+    if low_memory:
+        doc = pymupdf.open(pdf_path)
 
     print("...Done processing.")
+    print(f"Text elements: {text_counts['spans']} spans -> {text_counts['divs']} divs + {text_counts['inline_spans']} inline spans")
 
     # Add a cover image  
     if os.path.exists(cover_image) :
         print("\nProcessing cover image")
         cover_image_name = os.path.basename(cover_image)
-        shutil.copy2(cover_image, images_folder)
+        with run_stats.stage("cover"):
+            cover_data = downscale_cover_image(cover_image, doc.load_page(0).rect) if downscale_cover else None
+            if cover_data:
+                writer.writestr(f"OEBPS/image/{cover_image_name}", cover_data)
+            else:
+                writer.write(cover_image, f"OEBPS/image/{cover_image_name}")
         
         content_opf_items.append(
-                f'<item id="cover-image" href="image/{cover_image_name}" media-type="image/jpeg"/>\n'
+                f'<item id="cover-image" href="image/{cover_image_name}" media-type="{get_media_type(cover_image_name)}"/>\n'
             )
     else : print("Cover image missing.")
 
@@ -410,23 +685,434 @@ def create_epub_structure_from_pdf(pdf_path, output_folder, page_start_left, exp
 
     for fnt in fonts_in_pdf:
         print(fnt)
-    write_content_opf(oebps_folder,content_opf_items,xhtml_files,page)
-    write_toc_xhtml(oebps_folder, doc)
-    write_css_and_font_files(oebps_folder,font_folder_output,page)
-    print(f"\nEPUB structure created at: {output_folder}")
+    # Page size for the viewport and css comes from the last page
+    page = doc.load_page(doc.page_count - 1)
+    with run_stats.stage("opf_and_nav"):
+        write_content_opf(writer,content_opf_items,xhtml_files,page)
+        write_toc_xhtml(writer, doc)
+    with run_stats.stage("css_and_fonts"):
+        write_css_and_font_files(writer,page)
+    page = None
+    doc.close()
+    if low_memory:
+        content_opf_items.close()
+        xhtml_files.close()
+    with run_stats.stage("zip_close"):
+        writer.close()
+
+    # Time spent compressing and writing members, across all the stages above
+    run_stats.seconds["zip"] = writer.seconds
+    run_stats.add("zip_bytes_in", writer.bytes_in)
+    run_stats.add("zip_bytes_out", writer.compressed_bytes())
+    run_stats.add("epub_bytes", os.path.getsize(epub_path))
+
+    if page_cache:
+        evicted, cache_bytes = page_cache.evict()
+        print(f"\nPage cache: {cache_hits} hits, {page_count - cache_hits} misses, {evicted} files evicted, {cache_bytes / (1024 * 1024):.1f} MB in {page_cache.cache_dir}")
+    if output_folder:
+        print(f"\nEPUB structure kept at: {output_folder}")
+
+    report = run_stats.report(pdf=pdf_path, epub=epub_path, page_count=page_count, workers=workers)
+    print_run_stats(report)
+    if write_report:
+        report_path = os.path.splitext(epub_path)[0] + "_report.json"
+        save_report(report, report_path)
+        print(f"\nStage times and counts saved to {report_path}")
 
-def generate_html(page, page_num, page_name, image_counter):  
-    # Added language parameter
-    """Generates fixed-layout HTML for a single PDF page with one background image. Renders complete sentences without spans or divs except for italics etc.
+    print(f"\nEPUB file created at: {epub_path}\n")
+    return page_count
+
+def print_run_stats(report):
+    """Prints where the time went: the page stages (summed over pages) and the run stages."""
+    print(f"\nTotal {report['total_seconds']:.2f} s for {report['page_count']} pages")
+    print("Page stages (summed over pages):")
+    for name, seconds in report["page_seconds"].items():
+        if name != "page":
+            print(f"    {name:16} {seconds:8.3f} s")
+    print("Run stages:")
+    for name, seconds in report["run_seconds"].items():
+        print(f"    {name:16} {seconds:8.3f} s")
+    if report["stage_peak_mb"]:
+        print("Peak memory per stage:")
+        for name, peak in report["stage_peak_mb"].items():
+            print(f"    {name:16} {peak:8.1f} MB")
+    counts = report["counts"]
+    print(f"Images: {counts.get('image_bytes_in', 0) / 1024:.0f} KB in the pdf -> {counts.get('image_bytes_out', 0) / 1024:.0f} KB in the epub, "
+          f"zip: {counts.get('zip_bytes_in', 0) / 1024:.0f} KB -> {counts.get('zip_bytes_out', 0) / 1024:.0f} KB")
+    qualities = [page["details"]["quality"] for page in report["pages"] if "quality" in page["details"]]
+    if qualities:
+        print(f"Lossy quality {min(qualities)}-{max(qualities)} over {len(qualities)} images ({counts.get('image_encodes', 0)} encodes in all), "
+              f"{counts.get('images_over_budget', 0)} still over the byte budget")
+    formats = {image_format: counts[f"images_{image_format}"] for image_format in IMAGE_FORMATS if counts.get(f"images_{image_format}")}
+    if len(formats) > 1 or (formats and "jpeg" not in formats):
+        print("Re-encoded images: " + ", ".join(f"{count} {image_format}" for image_format, count in formats.items()))
+
+def split_page_ranges(page_count, workers, max_pages=None):
+    """Splits the pages into contiguous (start, stop) ranges, a few per worker so slow pages even out, and none longer than max_pages."""
+    if workers <= 1:
+        return [(0, page_count)]
+    chunk_count = min(page_count, workers * 4)
+    if max_pages:
+        chunk_count = max(chunk_count, -(-page_count // max_pages))
+    ranges = []
+    for chunk in range(chunk_count):
+        start = page_count * chunk // chunk_count
+        stop = page_count * (chunk + 1) // chunk_count
+        ranges.append((start, stop))
+    return ranges
+
+def split_page_ranges_by_cost(page_costs, max_pages):
+    """
+    Splits the pages into contiguous (start, stop) ranges of at most max_pages, from their estimated memory (MB).
+    A page more than twice as heavy as the median page gets a range of its own, so it doesn't make its light neighbours wait for memory.
+    """
+    median_cost = sorted(page_costs)[len(page_costs) // 2] if page_costs else 0
+    ranges = []
+    start = 0
+    for page_num, cost in enumerate(page_costs):
+        heavy = cost > 2 * median_cost
+        if page_num > start and (heavy or page_num - start >= max_pages):
+            ranges.append((start, page_num))
+            start = page_num
+        if heavy:
+            ranges.append((page_num, page_num + 1))
+            start = page_num + 1
+    if start < len(page_costs):
+        ranges.append((start, len(page_costs)))
+    return ranges
+
+def map_in_window(executor, function, calls, window):
+    """Like executor.map over a list of argument tuples, but with at most window calls submitted ahead of the one being read, so results can't pile up."""
+    pending = []
+    for arguments in calls:
+        pending.append(executor.submit(function, *arguments))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+def run_page_pipeline(convert_pages_on, threads, depth, page_cache=None):
+    """
+    Pipelined page loop: convert_pages_on(image_pool), an iterator of convert_page results, runs on a thread of its own and hands each background image
+    to a pool of threads that encode them, while the caller writes the finished pages to the epub. Pillow and zlib release the GIL, so the stages overlap.
+    Yields the finished results (see finish_page_result) in page order. At most depth pages wait between the stages, so only a few decoded images
+    are held at once. MuPDF is only used from the page thread.
     """
-    page_width = page.rect.width
-    page_height = page.rect.height
+    pages = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def hand_over(item):
+        # Waits for room in the queue, unless the caller has stopped reading
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def convert():
+        try:
+            for result in convert_pages_on(image_pool):
+                if not hand_over(result):
+                    return
+            hand_over(None)
+        except BaseException as error:
+            hand_over(error)
+
+    final_names = {}
+    with ThreadPoolExecutor(max_workers=threads) as image_pool:
+        page_thread = threading.Thread(target=convert, name="pages", daemon=True)
+        page_thread.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield finish_page_result(item, final_names, page_cache)
+        finally:
+            stop.set()
+            page_thread.join()
+
+def convert_page_range(pdf_path, page_range, cover_image, page_cache=None):
+    """
+    Converts a range of pages to XHTML and background images.
+    Opens the PDF itself so it can run in a worker process, and returns the generated files and manifest and font details for each page so the caller can merge them in page order.
+    """
+    return list(convert_pages(pdf_path, page_range, cover_image, page_cache))
+
+def convert_pages(pdf_path, page_range, cover_image, page_cache=None, image_pool=None):
+    """Converts a range of pages one at a time from its own copy of the open pdf. In low-memory mode MuPDF's memory is released after every page."""
+    start, stop = page_range
+    guard = MemoryGuard(pdf_path, memory_budget_mb, private=in_worker_process) if low_memory else None
+    doc = guard.doc if guard else pymupdf.open(pdf_path)
+
+    try:
+        for page_num in range(start, stop):
+            yield convert_page(doc, page_num, cover_image, page_cache, image_pool)
+            if guard:
+                doc = guard.page_done()
+    finally:
+        if guard:
+            guard.close()
+        else:
+            doc.close()
+
+def get_worker_options():
+    """The module settings worker processes need (a spawned worker only has the defaults)."""
+    return {name: globals()[name] for name in (
+        "language", "merge_spans", "merge_tolerance", "style_classes", "minify_html",
+        "export_json", "json_images", "json_compact", "low_memory", "memory_budget_mb", "max_image_size", "image_scale",
+        "jpeg_quality", "jpeg_min_quality", "jpeg_progressive", "jpeg_optimize", "jpeg_subsampling", "image_budget_bytes",
+        "image_formats",
+    )}
+
+def set_worker_options(options):
+    # Worker process initializer
+    globals().update(options)
+
+def get_page_options(cover_image):
+    """Options that change a page's output, part of the page cache key."""
+    return {
+        "language": language,
+        "cover_image": os.path.basename(cover_image),
+        "merge_spans": merge_spans,
+        "merge_tolerance": merge_tolerance,
+        "style_classes": style_classes,
+        "minify_html": minify_html,
+        "max_image_size": max_image_size,
+        "image_scale": image_scale,
+        "jpeg": get_jpeg_encoder().key(),
+        "image_formats": sorted(image_formats),
+        "image_budget_bytes": image_budget_bytes,
+    }
+
+def convert_page(doc, page_num, cover_image, page_cache=None, image_pool=None):
+    """
+    Single pass over one page: loads it once, generates its XHTML and background image and releases it before the next page.
+    With a page_cache, an unchanged page is taken from the cache instead.
+    With an image_pool (a thread pool) the background image is only decoded here and encoded on the pool: the result then
+    has to go through finish_page_result, which adds the image once it is encoded.
+    """
+    page_stats = PageStats(page_num, track_memory=low_memory)
+    page_start = time.perf_counter()
+
+    # Everything read from the page comes from this one extraction
+    with page_stats.stage("load_page"):
+        page_context = PageContext(doc.load_page(page_num), keep_images=export_json and json_images != "omit")
 
+    if page_num == 0:
+        page_name ="cover"  # First page as cover
+        page_label ="i"  # First page as Roman numeral (cover)
+    else:
+        page_name =  "page_" + str(page_num)  # Start second page at 1 
+        page_label = str(page_num)  # Start second page at 1 
+
+    html_file_name = f"{page_name}.xhtml"
+
+    # Fonts found on this page that this process has not seen yet
+    known_fonts = len(fonts_in_pdf)
+
+    images = page_context.images
+
+    # The background is the page's last image (earlier ones were always overwritten by it).
+    # The cover page uses the external cover file so its image is never read.
+    image_filename = None
+    image_is_new = False
+    if images and page_num != 0:
+        with page_stats.stage("image_hash"):
+            target_size = get_image_target_size(images[-1][2], images[-1][3], page_context.rect)
+            image_filename, image_is_new = get_image_name(doc, images[-1], target_size)
+
+    if page_cache:
+        with page_stats.stage("cache_lookup"):
+            # Keyed on the image name without its extension, which is only known once the image is encoded
+            cache_key = page_cache.page_key(page_context, image_filename and os.path.splitext(image_filename)[0], get_page_options(cover_image))
+            entry = page_cache.get(cache_key)
+        if entry:
+            page_stats.add("cache_hits")
+            for font_name in entry["page_fonts"]:
+                if font_name not in fonts_in_pdf:
+                    fonts_in_pdf.append(font_name)
+
+            # The entry may have been stored by another page with the same content
+            page_html = entry["html"]
+            if entry["page_label"] != page_label:
+                page_html = relabel_page_html(page_html, entry["page_label"], entry["page_name"], page_label, page_name)
+            members = [(f"OEBPS/{html_file_name}", page_html.encode("utf-8"))]
+            if image_is_new:
+                image_filename = rename_image(image_filename, os.path.splitext(entry["image_filename"])[1].lstrip("."))
+                members.append((f"OEBPS/image/{image_filename}", page_cache.read_image(image_filename)))
+
+            json_line = None
+            if export_json:
+                with page_stats.stage("json"):
+                    json_line = page_to_json_line(page_context.text_dict, page_num, json_images, json_compact)
+            page_context.close()
+            page_stats.seconds["page"] = time.perf_counter() - page_start
+
+            return {
+                "page_num": page_num,
+                "html_file_name": html_file_name,
+                "members": members,
+                "image_manifest": entry["image_manifest"],
+                "fonts": fonts_in_pdf[known_fonts:],
+                "codepoints": entry["page_codepoints"],
+                "counts": entry["page_counts"],
+                "styles": entry["page_styles"],
+                "image_log": ["cached"] if image_filename else [],
+                "image_filename": entry["image_filename"],
+                "json_line": json_line,
+                "cache_hit": True,
+                "stats": page_stats.as_dict(),
+            }
+
+    # The background goes first, its format (and so its file name) is only known once it is encoded
+    image_log = []
+    image_data = None
+    image_job = None
+    if image_is_new:
+        image_job = decode_page_image(doc, images[-1], page_stats, target_size, detach=bool(image_pool))
+        if image_pool and "result" not in image_job:
+            # Written with the provisional .jpg name, finish_page_result renames it if another format wins
+            image_stats = PageStats(page_num)
+            image_job = (image_pool.submit(finish_page_image, image_job, image_stats), image_stats)
+        else:
+            image_data, image_path, image_extension = finish_page_image(image_job, page_stats)
+            image_filename = rename_image(image_filename, image_extension)
+            image_log.append(image_path)
+            image_job = None
+    elif image_filename:
+        image_log.append(f"shared ({image_filename})")
+
+    # Generate fixed-layout HTML for the page
+    with page_stats.stage("extract_text"):
+        page_context.text_dict
+    page_info = {"fonts": [], "codepoints": {}, "styles": {}, "counts": {"spans": 0, "divs": 0, "inline_spans": 0}, "stats": page_stats}
+    with page_stats.stage("html"):
+        page_html, image_counter, image_manifest = generate_html(
+            page_context, page_label, page_name, 0, cover_image, image_filename, page_info
+        )
+    for count_name, count in page_info["counts"].items():
+        page_stats.add(count_name, count)
+    page_stats.add("html_bytes", len(page_html.encode("utf-8")))
+
+    page_codepoints = {font_name: "".join(sorted(characters)) for font_name, characters in page_info["codepoints"].items()}
+
+    # Files to add to the epub, in order
+    members = [(f"OEBPS/{html_file_name}", page_html.encode("utf-8"))]
+    if image_data is not None:
+        members.append((f"OEBPS/image/{image_filename}", image_data))
+
+    cache_entry = None
+    if page_cache:
+        cache_entry = (cache_key, {
+            "html": page_html,
+            "page_label": page_label,
+            "page_name": page_name,
+            "image_filename": image_filename,
+            "image_manifest": image_manifest,
+            "page_fonts": page_info["fonts"],
+            "page_codepoints": page_codepoints,
+            "page_counts": page_info["counts"],
+            "page_styles": page_info["styles"],
+        })
+        if not image_pool:
+            # A shared image encoded on an earlier page is already in the cache
+            cache_start = time.perf_counter()
+            page_cache.put(*cache_entry, image_data)
+            page_stats.seconds["cache_store"] = time.perf_counter() - cache_start
+            cache_entry = None
+
+    # The json export goes last as it rewrites the image blocks of the text dict
+    json_line = None
+    if export_json:
+        with page_stats.stage("json"):
+            json_line = page_to_json_line(page_context.text_dict, page_num, json_images, json_compact)
+    page_context.close()
+    page_stats.seconds["page"] = time.perf_counter() - page_start
+
+    return {
+        "page_num": page_num,
+        "html_file_name": html_file_name,
+        "members": members,
+        "image_manifest": image_manifest,
+        "fonts": fonts_in_pdf[known_fonts:],
+        "codepoints": page_codepoints,
+        "counts": page_info["counts"],
+        "styles": page_info["styles"],
+        "image_log": image_log,
+        "image_filename": image_filename,
+        "image_job": image_job,
+        "cache_entry": cache_entry,
+        "json_line": json_line,
+        "cache_hit": False,
+        "stats": page_stats.as_dict(),
+    }
+
+def finish_page_result(result, final_names, page_cache=None):
+    """
+    Completes a page result from convert_page with an image_pool: waits for its background image, adds it to the members and puts the page in the cache.
+    Pages are written with the provisional .jpg names, final_names (image stem -> file name, filled in page order) gives every page the name of the format its image was encoded in.
+    """
+    image_filename = result.get("image_filename")
+    image_data = None
+    image_job = result.pop("image_job", None)
+    if image_filename:
+        image_stem = os.path.splitext(image_filename)[0]
+        if image_job:
+            future, image_stats = image_job
+            image_data, image_path, image_extension = future.result()
+            merge_page_stats(result["stats"], image_stats.as_dict())
+            result["image_log"].append(image_path)
+            final_names[image_stem] = f"{image_stem}.{image_extension}"
+        final_name = final_names.setdefault(image_stem, image_filename)
+
+        if final_name != image_filename:
+            arcname, page_html = result["members"][0]
+            result["members"][0] = (arcname, page_html.replace(f'"image/{image_filename}"'.encode("utf-8"), f'"image/{final_name}"'.encode("utf-8")))
+            result["image_manifest"] = [{**img, "href": f"image/{final_name}"} if img["href"] == f"image/{image_filename}" else img for img in result["image_manifest"]]
+            result["image_log"] = [line.replace(image_filename, final_name) for line in result["image_log"]]
+            result["image_filename"] = final_name
+        if image_data is not None:
+            result["members"].append((f"OEBPS/image/{final_name}", image_data))
+
+    cache_entry = result.pop("cache_entry", None)
+    if cache_entry:
+        cache_key, entry = cache_entry
+        entry.update(html=result["members"][0][1].decode("utf-8"), image_filename=result["image_filename"], image_manifest=result["image_manifest"])
+        cache_start = time.perf_counter()
+        page_cache.put(cache_key, entry, image_data)
+        result["stats"]["seconds"]["cache_store"] = time.perf_counter() - cache_start
+    return result
+
+def get_page_title(page_name):
     # style page titles
     if page_name.startswith("page_") and page_name[5:].isdigit():
-        page_title = f"Page {page_name[5:]}"
-    else:
-        page_title = page_name.title()
+        return f"Page {page_name[5:]}"
+    return page_name.title()
+
+def relabel_page_html(page_html, old_label, old_name, page_label, page_name):
+    """
+    A cached page's xhtml for another page with the same content: its title, pagebreak id and aria-label are the only parts that
+    depend on which page it is. Text in the page is escaped, so these strings only occur in the markup.
+    """
+    for old, new in ((f"<title>{get_page_title(old_name)}</title>", f"<title>{get_page_title(page_name)}</title>"),
+                     (f'id="page{old_label}"', f'id="page{page_label}"'),
+                     (f'aria-label="Page {old_label}."', f'aria-label="Page {page_label}."')):
+        page_html = page_html.replace(old, new, 1)
+    return page_html
+
+def generate_html(page_context, page_num, page_name, image_counter, cover_image, image_filename=None, page_info=None):  
+    # Added language parameter
+    """Generates fixed-layout HTML for a single PDF page (read from its PageContext) with one background image. Renders complete sentences without spans or divs except for italics etc.
+    """
+    page_width = page_context.rect.width
+    page_height = page_context.rect.height
+
+    page_title = get_page_title(page_name)
 
     html_content = f"""<?xml version="1.0" encoding="UTF-8" standalone="no"?>
 <!DOCTYPE html>
@@ -442,115 +1128,610 @@ def generate_html(page, page_num, page_name, image_counter):
 <span epub:type="pagebreak" id="page{page_num}" role="doc-pagebreak" aria-label="Page {page_num}." />
 """
 
-    images = page.get_images(full=True)
+    images = page_context.images
     image_manifest = []  # Initialize as empty list
 
     if images:  # Check if there are any images
-        image_filename = f"{page_name}.jpg"  
+        if image_filename is None:
+            image_filename = f"{page_name}.jpg"  
 
         if page_title == "Cover": # use external cover image
             image_filename = os.path.basename(cover_image)
 
-        html_content += f'<img alt="ALT_TEXT_HERE" src="image/{image_filename}" style="position:absolute; left:0px; top:0px; width:{page_width}px; height:{page_height}px; z-index: -1;" />\n'
+        if minify_html: # position and z-index are already set for img in the css
+            html_content += f'<img alt="ALT_TEXT_HERE" src="image/{image_filename}" style="left:0px; top:0px; width:{page_width}px; height:{page_height}px;" />\n'
+        else:
+            html_content += f'<img alt="ALT_TEXT_HERE" src="image/{image_filename}" style="position:absolute; left:0px; top:0px; width:{page_width}px; height:{page_height}px; z-index: -1;" />\n'
 
         if page_title != "Cover":
             image_manifest = [{
-                'id': f"image_{image_counter}",
+                'id': os.path.splitext(image_filename)[0],
                 'href': f"image/{image_filename}"
             }]
         image_counter += 1
 
-    text_instances = page.get_text("dict")
-    if "blocks" in text_instances:
-        for block in text_instances["blocks"]:
-            if "lines" in block:
-                for line in block.get('lines', []):
-                    for span in line.get('spans', []):
-                        font_name = span["font"]
-                        if font_name not in fonts_in_pdf:
-                            fonts_in_pdf.append(font_name)
-                        if 'text' in span:
-                            left = span['origin'][0]
-                            top = span['origin'][1]
-                            size = span['size']
-                            # check for special characters i.e. &
-                            text = html.escape(span['text'])
-                            color = span['color']
-                            # adjust top to compensate for alignment
-                            top = top - size
-
-                            if int(color) != 0:
-                                hex_color = int_to_hex_color(int(color))
-                                text_color = f" color:{hex_color};"
-                            else:
-                                text_color = ""
-                                
-                            # if text is all caps convert to <strong> and title case
-                            if convert_allcaps(text):
-                                html_content += f'<div style="left:{left:.2f}px; top:{top:.2f}px; font-size:{size:.2f}px; font-family:\'{font_name}\'; {text_color}"><p><span class="upper">{titlecase(text)}</span></p></div>\n'
-                            else:
-                                html_content += f'<div style="left:{left:.2f}px; top:{top:.2f}px; font-size:{size:.2f}px; font-family:\'{font_name}\';{text_color}"><p>{text}</p></div>\n'
+    for line_spans in page_context.lines():
+        spans = []
+        for span in line_spans:
+            font_name = span["font"]
+            if font_name not in fonts_in_pdf:
+                fonts_in_pdf.append(font_name)
+            # Fonts and characters used on this page, for the page cache and font subsetting.
+            # Upper and lower case are both kept as all caps text is titlecased and shown uppercase by the css.
+            if page_info is not None:
+                if font_name not in page_info["fonts"]:
+                    page_info["fonts"].append(font_name)
+                raw_text = span.get('text', "")
+                page_info["codepoints"].setdefault(font_name, set()).update(raw_text, raw_text.upper(), raw_text.lower())
+            if 'text' in span:
+                spans.append(span)
+
+        if page_info is not None:
+            page_info["counts"]["spans"] += len(spans)
+
+        # Join the spans InDesign split a line into, within the merge tolerance
+        for run in merge_line_spans(spans, merge_tolerance if merge_spans else None, convert_allcaps):
+            html_content += generate_text_run(run, page_info)
 
     html_content += "</body></html>"
 
+    if minify_html:
+        html_content = minify_xhtml(html_content)
+
     return html_content, image_counter, image_manifest
 
+def generate_text_run(run, page_info=None):
+    """Writes one merged run as a positioned div. The first part sets the div's style, later parts with another style become inline spans."""
+    first_part = run["parts"][0]
+    left = run["origin"][0]
+    top = run["origin"][1]
+    size = first_part["size"]
+    font_name = first_part["font"]
+    # adjust top to compensate for alignment
+    top = top - size
+
+    inner_html = ""
+    for part_index, part in enumerate(run["parts"]):
+        # check for special characters i.e. &
+        text = html.escape(part["text"])
+
+        # if text is all caps convert to <span class="upper"> and title case
+        if convert_allcaps(text):
+            from titlecase import titlecase
+            if page_info is not None:
+                with page_info["stats"].stage("titlecase"):
+                    text = titlecase(text)
+            else:
+                text = titlecase(text)
+            text = f'<span class="upper">{text}</span>'
+
+        if part_index > 0:
+            if style_classes:
+                text = f'<span class="{get_style_class(part["font"], part["size"], part["color"], page_info)}">{text}</span>'
+            else:
+                text = f'<span style="{get_text_style(part["font"], part["size"], part["color"])}">{text}</span>'
+        inner_html += text
+
+    if page_info is not None:
+        page_info["counts"]["divs"] += 1
+        page_info["counts"]["inline_spans"] += len(run["parts"]) - 1
+
+    # Only the position stays inline when the style comes from a css class
+    if style_classes:
+        style_class = get_style_class(font_name, size, first_part["color"], page_info)
+        return f'<div class="{style_class}" style="left:{left:.2f}px; top:{top:.2f}px;"><p>{inner_html}</p></div>\n'
+    return f'<div style="left:{left:.2f}px; top:{top:.2f}px; {get_text_style(font_name, size, first_part["color"])}"><p>{inner_html}</p></div>\n'
+
+def get_text_style(font_name, size, color):
+    return f"font-size:{size:.2f}px; font-family:'{font_name}';{get_text_color(color)}"
+
+def get_style_class(font_name, size, color, page_info=None):
+    """
+    Returns the css class for a font/size/colour combination and registers its rule.
+    The name is a short hash of the style so every process (and the page cache) gives the same style the same class.
+    """
+    text_style = get_text_style(font_name, size, color)
+    style_class = "s" + hashlib.sha1(text_style.encode("utf-8")).hexdigest()[:6]
+    text_styles[style_class] = text_style
+    if page_info is not None:
+        page_info["styles"][style_class] = text_style
+    return style_class
+
+def minify_xhtml(html_content):
+    """Removes the line breaks and indentation between tags. Text never contains line breaks, so the text itself is untouched."""
+    return re.sub(r">\s*\n\s*<", "><", html_content)
+
+def get_text_color(color):
+    # Black is the default, only other colours are written
+    if int(color) != 0:
+        hex_color = int_to_hex_color(int(color))
+        return f" color:{hex_color};"
+    return ""
+
+def get_image_target_size(width, height, page_rect):
+    """
+    Size (width, height) a width x height background is resampled to on a page_rect page, from max_image_size and image_scale.
+    The aspect ratio is kept and image_scale is met in both directions. None when the image is small enough already.
+    """
+    factor = 1.0
+    if image_scale:
+        factor = min(factor, max(page_rect.width * image_scale / width, page_rect.height * image_scale / height))
+    if max_image_size:
+        factor = min(factor, max_image_size / max(width, height))
+    if factor >= 1.0:
+        return None
+    return max(1, round(width * factor)), max(1, round(height * factor))
+
+def get_image_budget_bytes(doc, cover_image):
+    """
+    Byte limit for each background image: image_max_kb, or book_images_max_mb less the cover shared evenly over the pdf's distinct
+    background images, whichever is lower. None without limits.
+    """
+    budget = image_max_kb * 1024 if image_max_kb else None
+    if book_images_max_mb:
+        cover_bytes = os.path.getsize(cover_image) if os.path.exists(cover_image) else 0
+        backgrounds = set()
+        for page_num in range(1, doc.page_count):
+            images = doc.get_page_images(page_num)
+            if images:
+                backgrounds.add(images[-1][0])
+        share = max(1, int(book_images_max_mb * 1024 * 1024) - cover_bytes) // max(1, len(backgrounds))
+        budget = min(budget, share) if budget else share
+    return budget
+
+def get_jpeg_encoder():
+    return JpegEncoder(jpeg_quality, jpeg_min_quality, jpeg_progressive, jpeg_optimize, jpeg_subsampling)
+
+def get_jpeg_passthrough(doc, img):
+    """
+    Returns the original stream bytes and a reason when an embedded image is already a JPEG the epub can use as is (DCTDecode, RGB or gray, no mask).
+    Returns None and the reason it has to be re-encoded otherwise.
+    """
+    xref, smask = img[0], img[1]
+    image_filter = img[8]
+
+    if image_filter != "DCTDecode":
+        return None, f"re-encoded ({image_filter or 'unfiltered'})"
+    if smask:
+        return None, "re-encoded (masked)"
+    # Checked before extract_image, which converts a CMYK JPEG to RGB (over a second for a full page) only for it to be thrown away
+    if get_image_components(doc, img) == 4:
+        return None, "re-encoded (CMYK)"
+
+    image_info = doc.extract_image(xref)
+    if image_info["ext"] != "jpeg":
+        return None, f"re-encoded ({image_info['ext']})"
+    if image_info["colorspace"] not in (1, 3):
+        return None, "re-encoded (CMYK)" if image_info["colorspace"] == 4 else "re-encoded (colorspace)"
+
+    return image_info["image"], "passthrough (JPEG)"
+
+def pixmap_to_image(pix):
+    """
+    Makes a PIL image of a gray or RGB Pixmap's samples without going through PNG.
+    Only a gray image without alpha shares the Pixmap's memory (Pillow maps L buffers, its image is readonly), so the Pixmap must outlive it.
+    Pillow copies the other modes as it reads them. Alpha is kept (LA/RGBA): MuPDF's samples are premultiplied by it, so they are read
+    as RGBa/La, which Pillow un-premultiplies.
+    """
+    from PIL import Image
+    modes = {(1, False): ("L", "L"), (1, True): ("La", "La"), (3, False): ("RGB", "RGB"), (3, True): ("RGBA", "RGBa")}
+    mode, raw_mode = modes[(pix.n - pix.alpha, bool(pix.alpha))]
+    image = Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, "raw", raw_mode, pix.stride, 1)
+    # Pillow only un-premultiplies gray by converting from its La mode
+    return image.convert("LA") if mode == "La" else image
+
+def get_image_name(doc, img, target_size=None):
+    """
+    Names an embedded image by a hash of its stream (and the size it is resampled to) so every page using the same picture shares one file.
+    Returns the file name and whether this process sees the image for the first time (and so has to encode it).
+    """
+    xref, smask = img[0], img[1]
+    image_key = (doc.name, xref, target_size)
+
+    if image_key not in image_names:
+        content_hash = hashlib.sha1(doc.xref_stream_raw(xref))
+        if smask:
+            content_hash.update(doc.xref_stream_raw(smask))
+        # Images encoded with other settings get other names, so they never mix in the page cache
+        image_settings = [f"{target_size[0]}x{target_size[1]}"] if target_size else []
+        if get_jpeg_encoder().key():
+            image_settings.append(get_jpeg_encoder().key())
+        if image_budget_bytes:
+            image_settings.append(f"max{image_budget_bytes}")
+        if list(image_formats) != ["jpeg"]:
+            image_settings.append("+".join(sorted(image_formats)))
+        if image_settings:
+            content_hash.update("|".join(image_settings).encode("utf-8"))
+        image_stem = f"img_{content_hash.hexdigest()[:16]}"
+        # Same picture stored under another xref. The extension is .jpg until the image is encoded in another format (rename_image)
+        known_names = [name for name in image_names.values() if os.path.splitext(name)[0] == image_stem]
+        image_filename = known_names[0] if known_names else f"{image_stem}.jpg"
+        image_names[image_key] = image_filename
+        return image_filename, not known_names
+
+    return image_names[image_key], False
+
+def rename_image(image_filename, extension):
+    """Gives an image the extension of the format it was encoded in, for every page that uses it. Returns the new name."""
+    new_filename = f"{os.path.splitext(image_filename)[0]}.{extension}"
+    if new_filename != image_filename:
+        for image_key, name in image_names.items():
+            if name == image_filename:
+                image_names[image_key] = new_filename
+    return new_filename
+
+def encode_page_image(doc, img, page_stats=None, target_size=None):
+    # Process single background image on the page and return its bytes, how it was handled and the file extension of its format
+    # page_stats (a PageStats) gets the decode, resize and encode times, the image bytes in and out and the format and quality used
+    # target_size (from get_image_target_size) resamples the image to that size before encoding
+    page_stats = page_stats or PageStats(None)
+    return finish_page_image(decode_page_image(doc, img, page_stats, target_size), page_stats)
+
+def decode_page_image(doc, img, page_stats, target_size=None, detach=False):
+    """
+    The part of encode_page_image that reads the pdf. Returns an image job for finish_page_image: the finished result for a JPEG that passes through,
+    otherwise the decoded PIL image. With detach the image holds no MuPDF memory, so the job can be finished on another thread.
+    """
+    from PIL import Image
+    xref, smask = img[0], img[1]
+    choose_format = list(image_formats) != ["jpeg"]
+
+    # Already a usable JPEG: keep the original bytes, no decode or quality loss
+    with page_stats.stage("image_decode"):
+        jpeg_bytes, image_path = get_jpeg_passthrough(doc, img)
+    over_budget = jpeg_bytes is not None and image_budget_bytes and len(jpeg_bytes) > image_budget_bytes
+    if jpeg_bytes is not None and target_size is None and not over_budget:
+        page_stats.add("image_bytes_in", len(jpeg_bytes))
+        page_stats.add("image_bytes_out", len(jpeg_bytes))
+        page_stats.details["image_bytes"] = len(jpeg_bytes)
+        return {"result": (jpeg_bytes, f"{image_path}, {len(jpeg_bytes) / 1024:.0f} KB", "jpg")}
+    if over_budget:
+        image_path = "re-encoded (over the byte budget)"
+
+    # The soft mask becomes the alpha channel when a format that can keep it is allowed
+    keep_alpha = bool(smask) and choose_format and ("png" in image_formats or "webp" in image_formats)
+    page_stats.add("image_bytes_in", get_stream_length(doc, xref))
+    with page_stats.stage("image_decode"):
+        pix = None
+        if jpeg_bytes is not None:
+            # A usable JPEG that only has to be smaller: decoded by Pillow, which can skip the detail that is scaled away (DCT scaling)
+            image = Image.open(io.BytesIO(jpeg_bytes))
+            if target_size:
+                image.draft(image.mode, target_size)
+            image.load()
+        else:
+            pix = pymupdf.Pixmap(doc, xref)
+            if pix.colorspace is None or pix.colorspace.n == 4:  # Check if it's CMYK (or a bare mask)
+                pix = pymupdf.Pixmap(pymupdf.csRGB, pix)  # Convert to RGB
+            if keep_alpha:
+                try:
+                    pix = pymupdf.Pixmap(pix, pymupdf.Pixmap(doc, smask))
+                except (ValueError, RuntimeError):
+                    keep_alpha = False  # a mask of another size, the image stays opaque
+            image = pixmap_to_image(pix)
+        image_mode = "RGBA" if keep_alpha else "RGB"
+        rgb_image = image if image.mode == image_mode else image.convert(image_mode) # Ensure PIL also treats it as RGB
+        if detach and pix is not None:
+            # Only a mapped image still points at the Pixmap's samples (see pixmap_to_image), the others are Pillow's own copy already
+            if rgb_image is image and image.readonly:
+                rgb_image = image.copy()
+            if rgb_image is not image:
+                image.close()
+            image, pix = rgb_image, None
+
+    # The Pixmap goes with the job so it outlives the images that share its samples
+    return {"image": rgb_image, "source": image, "pix": pix, "image_path": image_path, "size": (img[2], img[3]), "target_size": target_size}
+
+def finish_page_image(job, page_stats):
+    """
+    The part of encode_page_image that only uses Pillow: resamples and encodes the decoded image of a decode_page_image job.
+    Returns the image bytes, how it was handled and the file extension of its format.
+    """
+    from PIL import Image
+    if "result" in job:
+        return job["result"]
+    rgb_image, image, image_path, target_size = job["image"], job["source"], job["image_path"], job["target_size"]
+    choose_format = list(image_formats) != ["jpeg"]
+
+    if target_size:
+        with page_stats.stage("image_resize"):
+            resized_image = rgb_image.resize(target_size, Image.BILINEAR, reducing_gap=2.0)
+        if rgb_image is not image:
+            rgb_image.close()
+        rgb_image = resized_image
+        image_path = f"downscaled {job['size'][0]}x{job['size'][1]} -> {target_size[0]}x{target_size[1]}"
+        page_stats.add("images_downscaled")
+
+    # With a byte budget the quality is searched on the decoded image, it is not decoded again
+    encoder = get_jpeg_encoder()
+    with page_stats.stage("image_encode"):
+        if choose_format:
+            image_data, image_format, quality, analysis = encode_smallest(rgb_image, image_formats, encoder, image_budget_bytes)
+            encodes = analysis.pop("encodes")
+            page_stats.details.update(analysis)
+        elif image_budget_bytes:
+            image_data, quality, encodes = encoder.encode_within(rgb_image, image_budget_bytes)
+            image_format = "jpeg"
+        else:
+            image_data, quality, encodes = encoder.encode(rgb_image), encoder.quality, 1
+            image_format = "jpeg"
+    page_stats.add("image_bytes_out", len(image_data))
+    page_stats.add("image_encodes", encodes)
+    page_stats.add(f"images_{image_format}")
+    page_stats.details["image_format"] = image_format
+    if quality:
+        page_stats.details["quality"] = quality
+    page_stats.details["image_bytes"] = len(image_data)
+    if image_budget_bytes and len(image_data) > image_budget_bytes:
+        page_stats.add("images_over_budget")
+
+    # Clean up the image objects before the Pixmap whose samples they share
+    rgb_image.close()
+    image.close()
+    job.clear()
+
+    quality_note = f"quality {quality}" if quality else "lossless"
+    return image_data, f"{image_path}, {image_format} {quality_note}, {len(image_data) / 1024:.0f} KB", IMAGE_FORMATS[image_format][0]
+
+def downscale_cover_image(cover_image, page_rect):
+    """The external cover resampled to the background image limits for a page_rect page, in its own format. None when it is small enough."""
+    from PIL import Image
+    with Image.open(cover_image) as image:
+        target_size = get_image_target_size(image.width, image.height, page_rect)
+        if target_size is None:
+            return None
+        image_format = image.format
+        image.draft(image.mode, target_size)
+        source = image.convert("RGBA") if image.mode == "P" else image
+        resized_image = source.resize(target_size, Image.BILINEAR, reducing_gap=2.0)
+
+    cover_data = io.BytesIO()
+    resized_image.save(cover_data, image_format)
+    print(f"Cover image downscaled to {target_size[0]}x{target_size[1]}")
+    return cover_data.getvalue()
+
+def get_stream_length(doc, xref):
+    """Compressed size of an object's stream, from its /Length without reading the stream when it is a direct number."""
+    value_type, value = doc.xref_get_key(xref, "Length")
+    if value_type == "int":
+        return int(value)
+    return len(doc.xref_stream_raw(xref))
+
+def get_image_components(doc, img):
+    """Colour components per pixel of an embedded image, from its colorspace (the ICC profile's /N for ICCBased). Unknown colorspaces count as RGB."""
+    colorspace_names = f"{img[5]} {img[6]}"
+    if "CMYK" in colorspace_names:
+        return 4
+    if "Gray" in colorspace_names:
+        return 1
+    if "ICC" in colorspace_names:
+        value_type, value = doc.xref_get_key(img[0], "ColorSpace")
+        match = re.search(r"/ICCBased (\d+) 0 R", value)
+        if match:
+            value_type, value = doc.xref_get_key(int(match.group(1)), "N")
+            if value_type == "int":
+                return int(value)
+    return 3
+
+def estimate_page_memory_mb(doc, page_num):
+    """
+    Rough peak memory (MB) of converting a page, from its background image's size and colour components, without decoding anything.
+    A JPEG that passes through is only copied. A re-encoded image is decoded, converted to RGB and handed to Pillow: measured at about
+    (2 x components + 4) bytes per pixel (231 MB for a 20 MP CMYK JPEG, 193 MB for a 20 MP flate RGB image).
+    A JPEG that is only downscaled is decoded at no more than twice the target size each way.
+    """
+    images = doc.get_page_images(page_num, full=True)
+    if page_num == 0 or not images:
+        return PAGE_MEMORY_MB
+    img = images[-1]
+    components = get_image_components(doc, img)
+    if img[8] == "DCTDecode" and not img[1] and components in (1, 3):
+        target_size = get_image_target_size(img[2], img[3], doc.page_cropbox(page_num))
+        if target_size is None:
+            return PAGE_MEMORY_MB
+        return PAGE_MEMORY_MB + target_size[0] * target_size[1] * 4 * 3 / (1024 * 1024)
+    return PAGE_MEMORY_MB + img[2] * img[3] * (2 * components + 4) / (1024 * 1024)
+
 def process_images(pdf_path, output_folder_html):
-    # Process single background image on the page
-    image_path = os.path.join(output_folder_html,"OEBPS/image")
-       
+    # Process the background images of the whole document in a separate pass
     doc = pymupdf.open(pdf_path)
 
-    for page_index in range(len(doc)):
+    for page_index in range(1, len(doc)):
         page = doc[page_index]
         images = page.get_images(full=True)
-        
         if images:
+            target_size = get_image_target_size(images[-1][2], images[-1][3], page.rect)
+            image_filename, is_new = get_image_name(doc, images[-1], target_size)
+            if is_new:
+                image_data, image_path, image_extension = encode_page_image(doc, images[-1], target_size=target_size)
+                image_filename = rename_image(image_filename, image_extension)
+                image_path = os.path.join(output_folder_html, "OEBPS", "image", image_filename)
+                os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                with open(image_path, "wb") as f:
+                    f.write(image_data)
 
-            for img_index, img in enumerate(images):
-                xref = img[0]
+    doc.close()
 
-                pix = pymupdf.Pixmap(doc, xref)
-                if pix.colorspace.n == 4:  # Check if it's CMYK
-                    pix = pymupdf.Pixmap(pymupdf.csRGB, pix)  # Convert to RGB
+def scan_font_range(pdf_path, page_range):
+    """Reads the fonts the text of a range of pages is set in. Returns {font name: [page numbers]}, the names as the conversion matches them to font files."""
+    start, stop = page_range
+    font_pages = {}
 
-                image = Image.open(io.BytesIO(pix.tobytes()))
-                image = image.convert("RGB") # Ensure PIL also treats it as RGB
-                
-                if page_index == 0:
-                    page_label ="cover"  # First page is cover — don't create image as we will use the external file
-                else:
-                    page_label =  "page_" + str(page_index)  # Start second page at 1 
-                    image.save(f"{image_path}/{page_label}.jpg", "JPEG")
+    doc = pymupdf.open(pdf_path)
 
-                # Clean up the Pixmap object
-                pix = None
+    for page_num in range(start, stop):
+        page_context = PageContext(doc.load_page(page_num))
+        for font_name in page_context.span_fonts():
+            pages = font_pages.setdefault(font_name, [])
+            if not pages or pages[-1] != page_num:
+                pages.append(page_num)
+        page_context.close()
 
     doc.close()
+    return font_pages
+
+def format_page_list(page_nums):
+    """Page numbers as book pages (cover is i) with runs collapsed, e.g. i, 1-4, 7"""
+    runs = []
+    for page_num in page_nums:
+        if runs and page_num == runs[-1][1] + 1:
+            runs[-1][1] = page_num
+        else:
+            runs.append([page_num, page_num])
 
-def zip_folder_to_epub(folder_path, epub_path):
-    # Zips the folder structure and creates an EPUB file.
+    def label(page_num):
+        return "i" if page_num == 0 else str(page_num)
 
-    with zipfile.ZipFile(epub_path, 'w', zipfile.ZIP_STORED) as epubFile:
-        epubFile.writestr('mimetype', 'application/epub+zip')
+    return ", ".join(label(first) if first == last else f"{label(first)}-{label(last)}" for first, last in runs)
 
-        # Navigate to the exportFolderPath and add all files to the EPUB
-        os.chdir(folder_path)
-        for root, dirs, files in os.walk("."):
+def scan_fonts(pdf_path, font_folder, workers=1):
+    """Lists the fonts in the pdf, the pages they are on and whether a matching file is in the fonts folder. Builds no epub."""
+    doc = pymupdf.open(pdf_path)
+    page_count = doc.page_count
+    doc.close()
+
+    page_ranges = split_page_ranges(page_count, workers)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            range_results = list(executor.map(scan_font_range, [pdf_path] * len(page_ranges), page_ranges))
+    else:
+        range_results = [scan_font_range(pdf_path, page_range) for page_range in page_ranges]
+
+    # Merge in page order
+    font_pages = {}
+    for range_fonts in range_results:
+        for font_name, pages in range_fonts.items():
+            font_pages.setdefault(font_name, []).extend(pages)
+
+    font_files = {font["font_name"]: font["font_path"] for font in (generate_font_list(font_folder) if os.path.isdir(font_folder) else [])}
+
+    print(f"\nFonts used in the PDF ({len(font_pages)}). Add any missing ones to the 'fonts' folder using these exact names:\n")
+    missing = 0
+    for font_name in sorted(font_pages):
+        if font_name in font_files:
+            status = os.path.basename(font_files[font_name])
+        else:
+            status = "MISSING"
+            missing += 1
+        print(f"{font_name}\n    pages: {format_page_list(font_pages[font_name])}\n    file: {status}")
+
+    print(f"\n{len(font_pages) - missing} found, {missing} missing.")
+    return font_pages
+
+def zip_folder_to_epub(folder_path, epub_path):
+    # Zips a folder structure (e.g. a kept and hand edited _html folder) and creates an EPUB file.
+    # Images are stored and the text and fonts deflated, as in a converted epub.
+
+    with EpubWriter(epub_path, compress_level=zip_level, compress_threads=zip_threads) as writer:
+        # Add all files with their paths relative to the folder
+        for root, dirs, files in os.walk(folder_path):
             for file in files:
                 if file != 'mimetype':
-                    epubFile.write(os.path.join(root, file), compress_type=zipfile.ZIP_DEFLATED)
+                    file_path = os.path.join(root, file)
+                    with open(file_path, "rb") as f:
+                        writer.writestr(os.path.relpath(file_path, folder_path), f.read())
     print(f"\nEPUB file created at: {epub_path}\n")
 
 # Run process
-os.makedirs("fonts", exist_ok=True)
-
-font_list = generate_font_list(font_folder)
-fonts_in_pdf = []
-
-# Create epub
-print("Creating fixed epub")
-create_epub_structure_from_pdf(pdf_path, output_folder_html,page_start_left, export_json)
-    # Add ", False" after page_start_left if you want to see the json
-process_images(pdf_path,output_folder_html)
-zip_folder_to_epub(output_folder_html, epub_file_path)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert an InDesign pdf to a fixed-layout epub")
+    parser.add_argument("--workers", type=int, default=workers, help="Number of worker processes used to convert pages")
+    parser.add_argument("--keep-html", action="store_true", help="Also write the exploded epub folder (<name>_html) for debugging")
+    parser.add_argument("--cache", action="store_true", help="Reuse unchanged pages from earlier runs (kept in <name>_cache)")
+    parser.add_argument("--cache-size-mb", type=int, default=1024, help="Size limit of the page cache, least recently used pages are removed first")
+    parser.add_argument("--no-merge-spans", action="store_true", help="Write one positioned div per PDF span instead of joining them into lines")
+    parser.add_argument("--merge-tolerance", type=float, default=merge_tolerance, help="Largest gap (px) between spans that are joined into one line element")
+    parser.add_argument("--inline-styles", action="store_true", help="Write font, size and colour inline on every text element instead of css classes")
+    parser.add_argument("--minify", action="store_true", help="Strip whitespace between tags and the img styles already set in the css")
+    parser.add_argument("--subset-fonts", action="store_true", help="Cut the fonts down to the characters used in the PDF (needs fontTools)")
+    parser.add_argument("--export-json", action="store_true", help="Also write the raw pdf structure to <name>_rawstructure.ndjson, one page per line")
+    parser.add_argument("--json-images", choices=["omit", "hash", "base64"], default=json_images, help="Leave image data out of the json, replace it with sha1 and size, or keep it as base64")
+    parser.add_argument("--json-compact", action="store_true", help="Write the json without spaces after separators")
+    parser.add_argument("--no-report", action="store_true", help="Don't write the stage times and counts to <name>_report.json")
+    parser.add_argument("--profile", action="store_true", help="Run under cProfile and save the stats to <name>.prof (only this process is profiled, not --workers)")
+    parser.add_argument("--max-image-size", type=int, default=max_image_size, help="Resample background images whose longest side is over this many pixels")
+    parser.add_argument("--image-scale", type=float, default=image_scale, help="Resample background images to this multiple of the page size (e.g. 2 for high-density screens)")
+    parser.add_argument("--downscale-cover", action="store_true", help="Apply --max-image-size and --image-scale to the cover image too")
+    parser.add_argument("--jpeg-quality", type=int, default=jpeg_quality, help="Quality of re-encoded background images, the highest tried with a byte limit")
+    parser.add_argument("--jpeg-min-quality", type=int, default=jpeg_min_quality, help="Lowest quality tried to fit an image in its byte limit")
+    parser.add_argument("--jpeg-progressive", action="store_true", help="Write progressive jpegs")
+    parser.add_argument("--jpeg-optimize", action="store_true", help="Optimise the jpeg Huffman tables (smaller files, slower encode)")
+    parser.add_argument("--jpeg-subsampling", choices=["4:4:4", "4:2:2", "4:2:0"], default=jpeg_subsampling, help="Chroma subsampling of re-encoded images")
+    parser.add_argument("--image-max-kb", type=int, default=image_max_kb, help="Largest size of each background image, larger ones are re-encoded at the highest quality that fits")
+    parser.add_argument("--book-images-max-mb", type=float, default=book_images_max_mb, help="Largest size of all background images and the cover together, shared out evenly per image")
+    parser.add_argument("--image-formats", nargs="+", choices=list(IMAGE_FORMATS), default=list(image_formats), help="Formats re-encoded background images may use, the smallest suitable one is picked per image (e.g. jpeg png webp)")
+    parser.add_argument("--pipeline-threads", type=int, default=pipeline_threads, help="Encode background images on this many threads while the next pages are extracted and finished ones zipped (without --workers)")
+    parser.add_argument("--zip-level", type=int, choices=range(10), default=zip_level, metavar="0-9", help="Compression level of the epub's text and fonts (images are stored), default 6")
+    parser.add_argument("--zip-threads", type=int, default=zip_threads, help="Deflate the epub's text members on this many threads while the conversion goes on")
+    parser.add_argument("--low-memory", action="store_true", help="Keep memory flat on very long pdfs: reopen the pdf every few pages, stream pages in small batches and record the peak memory per stage")
+    parser.add_argument("--memory-budget-mb", type=int, default=memory_budget_mb, help="Keep the conversion under about this many MB: with --workers, pages only start while their estimated memory fits, otherwise the pdf's memory is released whenever the process goes over it (implies --low-memory)")
+    parser.add_argument("--scan-fonts", action="store_true", help="Only list the fonts in the pdf and check them against the fonts folder, no epub is built")
+    args = parser.parse_args()
+    workers = args.workers
+    subset_fonts = args.subset_fonts
+    merge_spans = not args.no_merge_spans
+    merge_tolerance = args.merge_tolerance
+    style_classes = not args.inline_styles
+    minify_html = args.minify
+    export_json = export_json or args.export_json
+    json_images = args.json_images
+    json_compact = args.json_compact
+    write_report = not args.no_report
+    max_image_size = args.max_image_size
+    image_scale = args.image_scale
+    downscale_cover = args.downscale_cover
+    jpeg_quality = args.jpeg_quality
+    jpeg_min_quality = args.jpeg_min_quality
+    jpeg_progressive = args.jpeg_progressive
+    jpeg_optimize = args.jpeg_optimize
+    jpeg_subsampling = args.jpeg_subsampling
+    image_max_kb = args.image_max_kb
+    book_images_max_mb = args.book_images_max_mb
+    image_formats = tuple(args.image_formats)
+    pipeline_threads = args.pipeline_threads
+    zip_level = args.zip_level
+    zip_threads = args.zip_threads
+    low_memory = args.low_memory
+    memory_budget_mb = args.memory_budget_mb
+
+    # Get pdf file
+    pdf_path = get_input_file('pdf')
+
+    # Set base path, everything else is found relative to the pdf
+    current_folder = os.path.dirname(pdf_path)
+    font_folder = os.path.join(current_folder, "fonts")
+    os.makedirs(font_folder, exist_ok=True)
+
+    # Font discovery only
+    if args.scan_fonts:
+        scan_fonts(pdf_path, font_folder, workers)
+        raise SystemExit
+
+    # Get cover image
+    cover_image = get_input_file('jpeg')
+
+    # set file paths
+    epub_file_name =  os.path.splitext(pdf_path)[0]
+    output_folder_html = os.path.join(epub_file_name + "_html")
+    epub_file_path = os.path.join(epub_file_name + ".epub")
+
+    font_list = generate_font_list(font_folder)
+
+    if args.cache:
+        page_cache = PageCache(epub_file_name + "_cache", args.cache_size_mb * 1024 * 1024, font_folder_fingerprint(font_list))
+
+    # Create epub
+    print("Creating fixed epub")
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.runcall(create_epub_structure_from_pdf, pdf_path, epub_file_path, page_start_left, export_json,
+            output_folder_html if args.keep_html else None)
+        profile_path = epub_file_name + ".prof"
+        profiler.dump_stats(profile_path)
+        print(f"Profile saved to {profile_path} (open with: python -m pstats {os.path.basename(profile_path)})")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+    else:
+        create_epub_structure_from_pdf(pdf_path, epub_file_path, page_start_left, export_json,
+            output_folder_html if args.keep_html else None)
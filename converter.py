@@ -0,0 +1,119 @@
+'''
+Converter
+
+Library API for converting books from other programs (a service, a batch job, a notebook) without the prompts and globals of the script.
+
+    from converter import Converter, BookMetadata, ConversionOptions
+
+    converter = Converter(ConversionOptions(subset_fonts=True, minify_html=True))
+    result = converter.convert("book.pdf", "cover.jpg", BookMetadata(title="The Title", isbn="9781234567890"))
+
+Importing this module does no work. The converter and the libraries it uses (pymupdf, pillow, titlecase) are imported on the first convert, or up front with Converter.load().
+'''
+
+import os
+from dataclasses import dataclass, asdict
+
+### Contents
+# BookMetadata
+# ConversionOptions
+# Converter
+
+@dataclass
+class BookMetadata:
+    """Metadata written into content.opf. Fields left as None keep the defaults at the top of convert_fixed_epub.py."""
+    title: str = None
+    author: str = None
+    language: str = None
+    publisher: str = None
+    date: str = None
+    description: str = None
+    rights: str = None
+    isbn: str = None
+
+@dataclass
+class ConversionOptions:
+    """How the book is converted. Fields left as None keep the defaults at the top of convert_fixed_epub.py."""
+    page_start_left: bool = None
+    workers: int = None
+    subset_fonts: bool = None
+    merge_spans: bool = None
+    merge_tolerance: float = None
+    style_classes: bool = None
+    minify_html: bool = None
+    export_json: bool = None
+    json_images: str = None
+    json_compact: bool = None
+    write_report: bool = None
+    low_memory: bool = None
+    memory_budget_mb: int = None
+    max_image_size: int = None
+    image_scale: float = None
+    downscale_cover: bool = None
+    jpeg_quality: int = None
+    jpeg_min_quality: int = None
+    jpeg_progressive: bool = None
+    jpeg_optimize: bool = None
+    jpeg_subsampling: str = None
+    image_max_kb: int = None
+    book_images_max_mb: float = None
+    image_formats: tuple = None
+    pipeline_threads: int = None
+    zip_level: int = None
+    zip_threads: int = None
+
+def _settings(config):
+    # Accepts a config object or a plain dict (e.g. read from a json file), None values are left at the defaults
+    if config is None:
+        return {}
+    if not isinstance(config, dict):
+        config = asdict(config)
+    return {name: value for name, value in config.items() if value is not None}
+
+class Converter:
+    """
+    Converts books with one set of options.
+
+    A Converter can convert any number of books one after another. The modules are imported once per process,
+    so a long-lived worker only pays the startup cost for its first book (or at start with load()).
+    Each book starts from the defaults, nothing is carried over from the book before. The conversion keeps its
+    per-book state in module globals, so only convert one book at a time per process.
+    """
+
+    def __init__(self, options=None, keep_html=False, cache_folder=None, cache_size_mb=1024):
+        self.options = options or ConversionOptions()
+        # keep the exploded epub next to the epub (<name>_html) for debugging
+        self.keep_html = keep_html
+        # folder for the page cache, so reconverting a book only converts the pages that changed
+        self.cache_folder = cache_folder
+        self.cache_size_mb = cache_size_mb
+
+    def load(self):
+        """Imports the converter and the libraries it uses, e.g. in a worker process initializer. Returns the converter module."""
+        import convert_fixed_epub
+        import PIL.Image
+        import titlecase
+        return convert_fixed_epub
+
+    def convert(self, pdf_path, cover_image_path, metadata=None, epub_path=None, font_folder=None):
+        """
+        Converts one pdf to a fixed-layout epub. metadata is a BookMetadata (or dict), the epub is written next to the pdf
+        and the fonts are read from the "fonts" folder beside it unless epub_path or font_folder are given.
+        Returns a dict with the epub path, page count and epub size.
+        """
+        convert_fixed_epub = self.load()
+
+        epub_path = epub_path or os.path.splitext(pdf_path)[0] + ".epub"
+        output_folder = os.path.splitext(epub_path)[0] + "_html" if self.keep_html else None
+
+        return convert_fixed_epub.convert_book(
+            pdf_path,
+            cover_image_path,
+            metadata=_settings(metadata),
+            options=_settings(self.options),
+            epub_path=epub_path,
+            font_folder=font_folder,
+            output_folder=output_folder,
+            cache_folder=self.cache_folder,
+            cache_size_mb=self.cache_size_mb,
+        )
@@ -0,0 +1,250 @@
+'''
+Epub writer
+
+Streams the generated files straight into the epub archive so the book never has to be staged in a folder first.
+'''
+
+import io
+import os
+import time
+import zlib
+import shutil
+import struct
+import sys
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+### Contents
+# EpubWriter
+# get_compress_type
+# get_sample
+# deflate
+# can_write_deflated
+# write_deflated
+# check_ocf
+
+# media types that are compressed already, stored unless a sample of the member shows that deflate still gains (see get_compress_type)
+STORED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".woff", ".woff2")
+# bytes from the middle of a media member that are test compressed, and the saving from which it is deflated after all
+SAMPLE_BYTES = 64 * 1024
+SAMPLE_SAVING = 0.1
+MIMETYPE = b"application/epub+zip"
+# CPython versions whose zipfile write path was read for what _compressor does (ZipFile.open writes members from 3.6)
+DEFLATED_MEMBER_PYTHONS = ((3, 6), (3, 13))
+# whether zipfile takes members deflated on the compress pool, tried once (see can_write_deflated)
+write_deflated_works = None
+
+class EpubWriter:
+    """
+    Writes epub members directly into the zip file.
+
+    The mimetype is written first and stored uncompressed. If debug_folder is set every member is also written to that folder so the exploded book can be inspected.
+    Images are stored and text and fonts deflated (see get_compress_type) at compress_level (zlib's 0-9, None for its default 6).
+    With compress_threads the deflating runs on that many threads while the caller goes on, and the members are still written in the order they were added.
+    The rules the OCF container spec sets for the mimetype are checked when the epub is closed.
+    The time spent compressing and writing and the member bytes going in are kept for the run report.
+    """
+
+    def __init__(self, epub_path, debug_folder=None, compress_level=None, compress_threads=0):
+        self.epub_path = epub_path
+        self.debug_folder = debug_folder
+        self.compress_level = compress_level
+        self.seconds = 0.0
+        self.bytes_in = 0
+        # members waiting for their compression to finish, written in order. At most window of them are held
+        if compress_threads and not can_write_deflated():
+            print("Warning: this Python's zipfile can't take members deflated on other threads, compressing on one thread")
+            compress_threads = 0
+        self.compress_pool = ThreadPoolExecutor(max_workers=compress_threads) if compress_threads else None
+        self.pending = deque()
+        self.window = compress_threads * 4
+        self.ocf_problems = []
+        self.epub_file = zipfile.ZipFile(epub_path, 'w', zipfile.ZIP_STORED)
+        self.writestr("mimetype", MIMETYPE, compress_type=zipfile.ZIP_STORED)
+
+    def writestr(self, arcname, data, compress_type=None):
+        """Adds a generated member (str or bytes) to the epub, compressed as get_compress_type says unless compress_type is given."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        start = time.perf_counter()
+        if compress_type is None:
+            compress_type = get_compress_type(arcname, get_sample(data))
+        if self.compress_pool:
+            deflated = self.compress_pool.submit(deflate, data, self.compress_level) if compress_type == zipfile.ZIP_DEFLATED else None
+            self.pending.append((arcname, data, compress_type, deflated))
+            self._write_pending(len(self.pending) - self.window)
+        else:
+            self.epub_file.writestr(arcname, data, compress_type=compress_type, compresslevel=self.compress_level)
+        self.seconds += time.perf_counter() - start
+        self.bytes_in += len(data)
+
+        if self.debug_folder:
+            debug_path = self._debug_path(arcname)
+            with open(debug_path, "wb") as f:
+                f.write(data)
+
+    def write(self, source_path, arcname, compress_type=None):
+        """Adds an existing file (fonts, cover) to the epub from its source path."""
+        start = time.perf_counter()
+        if compress_type is None:
+            with open(source_path, "rb") as f:
+                f.seek(max(0, os.path.getsize(source_path) - SAMPLE_BYTES) // 2)
+                compress_type = get_compress_type(arcname, f.read(SAMPLE_BYTES))
+        self._write_pending(len(self.pending))
+        self.epub_file.write(source_path, arcname, compress_type=compress_type, compresslevel=self.compress_level)
+        self.seconds += time.perf_counter() - start
+        self.bytes_in += os.path.getsize(source_path)
+
+        if self.debug_folder:
+            shutil.copyfile(source_path, self._debug_path(arcname))
+
+    def _write_pending(self, wait_for=0):
+        """Writes the queued members in order: the first wait_for of them, waiting for their compression if needed, and then any that are ready."""
+        written = 0
+        while self.pending:
+            arcname, data, compress_type, deflated = self.pending[0]
+            if written >= wait_for and deflated is not None and not deflated.done():
+                break
+            self.pending.popleft()
+            if deflated is None:
+                self.epub_file.writestr(arcname, data, compress_type=compress_type, compresslevel=self.compress_level)
+            else:
+                write_deflated(self.epub_file, arcname, data, deflated.result(), self.compress_level)
+            written += 1
+
+    def close(self):
+        start = time.perf_counter()
+        self._write_pending(len(self.pending))
+        self.seconds += time.perf_counter() - start
+        if self.compress_pool:
+            self.compress_pool.shutdown()
+        self.epub_file.close()
+        self.ocf_problems = check_ocf(self.epub_path)
+        for problem in self.ocf_problems:
+            print(f"Warning: {self.epub_path} breaks the OCF container rules: {problem}")
+
+    def compressed_bytes(self):
+        """Bytes of the members as stored in the zip."""
+        return sum(info.compress_size for info in self.epub_file.infolist())
+
+    def _debug_path(self, arcname):
+        debug_path = os.path.join(self.debug_folder, *arcname.split("/"))
+        os.makedirs(os.path.dirname(debug_path), exist_ok=True)
+        return debug_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class _Deflated:
+    """Stands in for zipfile's compressor when the member's data was deflated already: returns those bytes once."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def compress(self, data):
+        compressed, self.data = self.data, b""
+        return compressed
+
+    def flush(self):
+        return b""
+
+def get_compress_type(arcname, sample=b""):
+    """
+    Deflates text and ttf/otf fonts, and stores the mimetype and members of media types that are compressed already (images, woff fonts).
+    Deflating a photo's jpeg gains nothing, but flat colour art saved as jpeg or png can still shrink by a fifth, so a media member is deflated
+    after all when a quick level 1 deflate of sample (get_sample) saves at least SAMPLE_SAVING.
+    """
+    if arcname == "mimetype":
+        return zipfile.ZIP_STORED
+    if os.path.splitext(arcname)[1].lower() not in STORED_EXTENSIONS:
+        return zipfile.ZIP_DEFLATED
+    if sample and len(deflate(sample, 1)) <= len(sample) * (1 - SAMPLE_SAVING):
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+def get_sample(data):
+    """SAMPLE_BYTES from the middle of a member, past the headers and tables at its start."""
+    start = max(0, len(data) - SAMPLE_BYTES) // 2
+    return data[start:start + SAMPLE_BYTES]
+
+def deflate(data, level=None):
+    """data as the raw deflate stream zipfile writes for a member at level, so it can be compressed on another thread."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+def can_write_deflated():
+    """
+    Whether write_deflated can hand zipfile the deflated bytes. That goes through the private _compressor of a member open for writing, so it is
+    only used on the CPython versions in DEFLATED_MEMBER_PYTHONS, and only once a member written that way into a zip in memory reads back
+    right (testzip and the data). EpubWriter compresses on one thread when it can't.
+    """
+    global write_deflated_works
+    if write_deflated_works is None:
+        write_deflated_works = False
+        if sys.implementation.name == "cpython" and DEFLATED_MEMBER_PYTHONS[0] <= sys.version_info[:2] <= DEFLATED_MEMBER_PYTHONS[1]:
+            data = MIMETYPE * 1000
+            buffer = io.BytesIO()
+            try:
+                with zipfile.ZipFile(buffer, "w") as zip_file:
+                    _write_precompressed(zip_file, "test", data, deflate(data))
+                with zipfile.ZipFile(buffer) as zip_file:
+                    write_deflated_works = zip_file.testzip() is None and zip_file.read("test") == data
+            except Exception as e:
+                print(f"Writing members deflated ahead failed ({type(e).__name__}: {e}), zipfile compresses them itself")
+    return write_deflated_works
+
+def write_deflated(zip_file, arcname, data, deflated, level=None):
+    """Adds a member whose data was deflated already (deflate at level). Where can_write_deflated says that doesn't work, zipfile compresses data itself."""
+    if can_write_deflated():
+        _write_precompressed(zip_file, arcname, data, deflated)
+    else:
+        zip_file.writestr(arcname, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=level)
+
+def _write_precompressed(zip_file, arcname, data, deflated):
+    # Only called on the real epub once can_write_deflated's trial in memory has passed
+    zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = len(data)
+    with zip_file.open(zinfo, "w") as member:
+        # The member works out the CRC and sizes from the data as usual, but writes the deflated bytes instead of compressing again
+        if not hasattr(member, "_compressor"):
+            raise AttributeError("zipfile members have no _compressor")
+        member._compressor = _Deflated(deflated)
+        member.write(data)
+
+def check_ocf(epub_path):
+    """
+    Checks an epub against the OCF container rules reading systems rely on: the mimetype is the first member, stored, without an extra field
+    (in its local header too, so its text sits at byte 38) and says application/epub+zip, and META-INF/container.xml is there. Returns the problems found.
+    """
+    problems = []
+    with open(epub_path, "rb") as f:
+        local_header = f.read(30)
+        if len(local_header) < 30 or local_header[:4] != b"PK\x03\x04":
+            return ["not a zip file"]
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        if f.read(name_length) != b"mimetype":
+            problems.append("the first member is not the mimetype")
+        elif extra_length:
+            problems.append("the mimetype's local header has an extra field")
+
+    with zipfile.ZipFile(epub_path) as epub_file:
+        members = {info.filename: info for info in epub_file.infolist()}
+        mimetype = members.get("mimetype")
+        if mimetype is None:
+            problems.append("there is no mimetype")
+        else:
+            if mimetype.compress_type != zipfile.ZIP_STORED:
+                problems.append("the mimetype is compressed")
+            if mimetype.extra:
+                problems.append("the mimetype has an extra field")
+            if epub_file.read("mimetype") != MIMETYPE:
+                problems.append("the mimetype is not application/epub+zip")
+        if "META-INF/container.xml" not in members:
+            problems.append("there is no META-INF/container.xml")
+    return problems
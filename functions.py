@@ -3,15 +3,16 @@ Functions
 '''
 
 import os, pathlib
-import tkinter as tk
-from tkinter import filedialog
 import json
 import base64
+import hashlib
 
 ### Contents
 # get_input_file
 # get_file_by_type
 # extract_pdf_to_json
+# page_to_json_line
+# merge_line_spans
 # write_toc_ncx
 
 def get_input_file(type="epub",testFile=None): 
@@ -60,6 +61,10 @@ def get_file_by_type(file_type,exportFolderPath=None,  initial_dir=None):
         print(f"Invalid file type: {file_type}. Supported types are 'epub', 'excel' 'pdf', 'jpeg' or a folder.")
         return None
 
+    # tkinter is only loaded when a dialog is needed, so headless hosts can import this module
+    import tkinter as tk
+    from tkinter import filedialog
+
     # Open the file dialog with the correct filter based on file type
     root = tk.Tk()
     root.withdraw()  # Hide the main window
@@ -81,26 +86,95 @@ def get_file_by_type(file_type,exportFolderPath=None,  initial_dir=None):
     
     return path
 
-def extract_pdf_to_json(doc, output_json_path):
-    """Extracts all pages of a PDF as JSON and writes to a file for checking purposes"""
-    pages_data = []
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        page_dict = page.get_text("dict")  # Extract page data in dict format        
-        # Process blocks to handle binary data
-        for block in page_dict.get("blocks", []):
-            if "image" in block and isinstance(block["image"], bytes):
-                # Convert image bytes to base64 string
-                block["image"] = base64.b64encode(block["image"]).decode("utf-8")
-        page_data = {
-            "page_num": page_num + 1,  # Human-readable page number
-            "content": page_dict,
-        }
-        pages_data.append(page_data)
+def extract_pdf_to_json(doc, output_json_path, images="hash", compact=False):
+    """
+    Streams the structure of every page of a PDF to a file for checking purposes, one JSON object per line (NDJSON).
+
+    Only one page is held in memory at a time. images sets what happens to image payloads:
+    "omit" leaves image blocks out (they are never decoded), "hash" replaces the bytes with their sha1 and size, "base64" keeps them.
+    compact drops the spaces after separators.
+    """
+    from page_context import PageContext
+
     with open(output_json_path, "w", encoding="utf-8") as json_file:
-        json.dump(pages_data, json_file, indent=4, ensure_ascii=False)
+        for page_num in range(len(doc)):
+            page_context = PageContext(doc.load_page(page_num), keep_images=images != "omit")
+            json_file.write(page_to_json_line(page_context.text_dict, page_num, images, compact))
+
+            # release the page before the next one
+            page_context.close()
+
     print(f"PDF content extracted and saved to {output_json_path}")
 
+def page_to_json_line(page_dict, page_num, images="hash", compact=False):
+    """One page's dict structure as a line of NDJSON. Image and mask bytes are hashed or base64 encoded in place."""
+    separators = (",", ":") if compact else (", ", ": ")
+
+    # Process blocks to handle binary data (image and mask bytes)
+    for block in page_dict.get("blocks", []):
+        for key, value in block.items():
+            if isinstance(value, bytes):
+                if images == "base64":
+                    block[key] = base64.b64encode(value).decode("utf-8")
+                else:
+                    block[key] = {"sha1": hashlib.sha1(value).hexdigest(), "size": len(value)}
+    page_data = {
+        "page_num": page_num + 1,  # Human-readable page number
+        "content": page_dict,
+    }
+    return json.dumps(page_data, ensure_ascii=False, separators=separators) + "\n"
+
+def merge_line_spans(spans, tolerance=2.0, is_all_caps=None):
+    """
+    Groups the spans of one PyMuPDF line into runs that can each be written as a single positioned element.
+
+    A span joins the current run when it sits on the same baseline and starts within tolerance (px) of where the previous span ended.
+    Adjacent spans with the same font, size and colour are joined into one part; a style change inside a run becomes a new part.
+    With is_all_caps (the converter's all caps check on a text) a span only joins a part when the check gives the joined text the same
+    answer as each of the two (a side without letters has no say), so all caps text is still recognised as it was in its own span.
+    With tolerance=None every span is its own run (no merging).
+
+    Returns a list of runs, each {"origin": (x, y), "parts": [{"text", "font", "size", "color"}, ...]}
+    """
+    runs = []
+    previous_end = None
+
+    def same_caps(text, added):
+        joined = is_all_caps(text + added)
+        return all(is_all_caps(side) == joined for side in (text, added) if any(char.isalpha() for char in side))
+
+    for span in spans:
+        part = {
+            "text": span["text"],
+            "font": span["font"],
+            "size": span["size"],
+            "color": span["color"],
+        }
+        x, y = span["origin"]
+
+        joins_run = (
+            tolerance is not None
+            and runs
+            and abs(y - runs[-1]["origin"][1]) <= tolerance
+            and -tolerance <= x - previous_end <= tolerance
+        )
+
+        if not joins_run:
+            runs.append({"origin": (x, y), "parts": [part]})
+        else:
+            last_part = runs[-1]["parts"][-1]
+            if (last_part["font"] == part["font"]
+                    and abs(last_part["size"] - part["size"]) < 0.01
+                    and last_part["color"] == part["color"]
+                    and (is_all_caps is None or same_caps(last_part["text"], part["text"]))):
+                last_part["text"] += part["text"]
+            else:
+                runs[-1]["parts"].append(part)
+
+        previous_end = span["bbox"][2]
+
+    return runs
+
 # Create NCX (Deprecated)
 def write_toc_ncx(oebps_folder, doc):
     """This generates an EPUB 2 type navigation. Deprecated."""
@@ -0,0 +1,121 @@
+'''
+Image format
+
+Picks the format of each re-encoded background image. A small copy of the decoded image shows whether it is flat colour art
+(few colours, low entropy), a photo-like picture or transparent, and the image is encoded in the allowed formats that suit that kind
+of picture. The smallest one is kept.
+'''
+
+import io
+import os
+
+### Contents
+# analyse_image
+# candidate_formats
+# encode_lossless
+# encode_smallest
+# get_media_type
+
+# file extension and manifest media type of each format
+IMAGE_FORMATS = {
+    "jpeg": ("jpg", "image/jpeg"),
+    "png": ("png", "image/png"),
+    "webp": ("webp", "image/webp"),
+}
+# longest side of the copy the image is analysed on
+ANALYSIS_SIZE = 256
+# luminance entropy (bits) from which a picture counts as a photo, flat colour art measures about 2-3.5 and photos 7 or more
+FLAT_ENTROPY = 5.0
+# most colours a flat picture can have in the analysed copy to be written losslessly without also trying the lossy formats
+FLAT_COLORS = 256
+
+def analyse_image(image):
+    """Colour count (None when over FLAT_COLORS), luminance entropy and transparency of a PIL image, from a nearest-neighbour copy of at most ANALYSIS_SIZE pixels."""
+    from PIL import Image
+    scale = min(1.0, ANALYSIS_SIZE / max(image.size))
+    small_image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.NEAREST)
+
+    colors = small_image.convert("RGB").getcolors(FLAT_COLORS)
+    alpha = "A" in small_image.getbands() and small_image.getchannel("A").getextrema()[0] < 255
+    return {
+        "colors": len(colors) if colors else None,
+        "entropy": round(small_image.convert("L").entropy(), 2),
+        "alpha": alpha,
+    }
+
+def candidate_formats(analysis, allowed_formats):
+    """
+    The (format, lossy) encodings worth trying for an analysed image, out of the allowed formats: JPEG and lossy WebP for photos,
+    lossless PNG and WebP for flat art, all of them for flat art with too many colours (e.g. saved as JPEG before), and no JPEG
+    for transparent images. JPEG when none of them is allowed.
+    """
+    lossless = [("png", False), ("webp", False)]
+    lossy = [("jpeg", True), ("webp", True)]
+    if analysis["alpha"]:
+        wanted = lossless + [("webp", True)]
+    elif analysis["entropy"] >= FLAT_ENTROPY:
+        wanted = lossy
+    elif analysis["colors"] is not None:
+        wanted = lossless
+    else:
+        wanted = lossless + lossy
+    candidates = [candidate for candidate in wanted if candidate[0] in allowed_formats]
+    return candidates or [("jpeg", True)]
+
+def encode_lossless(image, image_format):
+    """
+    PNG or lossless WebP bytes. A PNG of an image with at most 256 colours is written with a palette,
+    but only if the palette keeps every pixel exactly.
+    """
+    from PIL import ImageChops
+    data = io.BytesIO()
+    if image_format == "png":
+        if image.mode == "RGB" and image.getcolors(256):
+            palette_image = image.quantize(256)
+            if ImageChops.difference(palette_image.convert("RGB"), image).getbbox() is None:
+                image = palette_image
+        image.save(data, "PNG", optimize=True)
+    else:
+        image.save(data, "WEBP", lossless=True)
+    return data.getvalue()
+
+def encode_smallest(image, allowed_formats, encoder, max_bytes=None):
+    """
+    Encodes a PIL image (RGB, or RGBA when it has transparency) in its candidate formats and keeps the smallest.
+    Lossy formats use the encoder's (a JpegEncoder) quality, or the highest quality that fits max_bytes. When no candidate fits max_bytes,
+    the allowed lossy formats are tried too. Returns the bytes, the format, the quality (None for lossless) and the analysis with the encode count.
+    """
+    analysis = analyse_image(image)
+    candidates = candidate_formats(analysis, allowed_formats)
+    suited = len(candidates)
+    if max_bytes:
+        candidates += [(image_format, True) for image_format in ("jpeg", "webp") if image_format in allowed_formats and (image_format, True) not in candidates]
+
+    results = []
+    encodes = 0
+    for index, (image_format, lossy) in enumerate(candidates):
+        # The fallback lossy formats are only tried when nothing so far fits
+        if index >= suited and min(len(result[0]) for result in results) <= max_bytes:
+            break
+        if lossy:
+            # jpeg can't keep transparency
+            source = image.convert("RGB") if image_format == "jpeg" and image.mode != "RGB" else image
+            if max_bytes:
+                data, quality, format_encodes = encoder.encode_within(source, max_bytes, image_format.upper())
+            else:
+                data, quality, format_encodes = encoder.encode(source, image_format=image_format.upper()), encoder.quality, 1
+            encodes += format_encodes
+        else:
+            data, quality = encode_lossless(image, image_format), None
+            encodes += 1
+        results.append((data, image_format, quality))
+
+    data, image_format, quality = min(results, key=lambda result: len(result[0]))
+    analysis["encodes"] = encodes
+    return data, image_format, quality, analysis
+
+def get_media_type(file_name):
+    """Manifest media type of an image file from its extension (jpeg when unknown)."""
+    extension = os.path.splitext(file_name)[1].lower().lstrip(".")
+    media_types = {extension: media_type for extension, media_type in IMAGE_FORMATS.values()}
+    return media_types.get("jpg" if extension == "jpeg" else extension, "image/jpeg")
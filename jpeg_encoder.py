@@ -0,0 +1,80 @@
+'''
+Jpeg encoder
+
+Encodes the background images with configurable Pillow JPEG settings, and finds the highest quality that fits a byte budget.
+'''
+
+import io
+
+### Contents
+# JpegEncoder
+
+class JpegEncoder:
+    """
+    Pillow JPEG settings for the background images.
+
+    quality is used when there is no byte budget and is the highest quality tried when there is one, min_quality the lowest.
+    subsampling is "4:4:4", "4:2:2" or "4:2:0" (None leaves it to Pillow, 4:2:0). progressive and optimize (optimised Huffman tables)
+    give smaller files for a little more encode time. Lossy WebP (image_format="WEBP") uses the same qualities.
+    """
+
+    def __init__(self, quality=75, min_quality=30, progressive=False, optimize=False, subsampling=None):
+        self.quality = quality
+        self.min_quality = min(min_quality, quality)
+        self.progressive = progressive
+        self.optimize = optimize
+        self.subsampling = subsampling
+
+    def key(self):
+        """The settings as a short string for image names and cache keys, empty for Pillow's defaults."""
+        settings = []
+        if self.quality != 75:
+            settings.append(f"q{self.quality}")
+        if self.progressive:
+            settings.append("progressive")
+        if self.optimize:
+            settings.append("optimize")
+        if self.subsampling:
+            settings.append(self.subsampling)
+        return ",".join(settings)
+
+    def encode(self, image, quality=None, image_format="JPEG"):
+        """JPEG (or lossy WebP) bytes of a PIL image at quality (default self.quality)."""
+        options = {"quality": quality or self.quality}
+        if image_format == "JPEG":
+            if self.progressive:
+                options["progressive"] = True
+            if self.optimize:
+                options["optimize"] = True
+            if self.subsampling:
+                options["subsampling"] = self.subsampling
+        data = io.BytesIO()
+        image.save(data, image_format, **options)
+        return data.getvalue()
+
+    def encode_within(self, image, max_bytes, image_format="JPEG"):
+        """
+        Encodes at the highest quality from min_quality to quality whose file fits in max_bytes, by a binary search over the same decoded image.
+        Returns the bytes, the quality and the number of encodes. If even min_quality doesn't fit, that encode is returned.
+        """
+        data = self.encode(image, image_format=image_format)
+        if len(data) <= max_bytes or self.min_quality >= self.quality:
+            return data, self.quality, 1
+
+        # The lowest quality first, so an image that can't fit costs one more encode instead of a whole search
+        best = (self.encode(image, self.min_quality, image_format), self.min_quality)
+        encodes = 2
+        if len(best[0]) > max_bytes:
+            return best[0], best[1], encodes
+
+        low, high = self.min_quality + 1, self.quality - 1
+        while low <= high:
+            quality = (low + high) // 2
+            data = self.encode(image, quality, image_format)
+            encodes += 1
+            if len(data) <= max_bytes:
+                best = (data, quality)
+                low = quality + 1
+            else:
+                high = quality - 1
+        return best[0], best[1], encodes
@@ -0,0 +1,190 @@
+'''
+Memory guard
+
+Low-memory mode: keeps the memory of a run flat however many pages the pdf has, and measures the peak memory of each stage.
+'''
+
+import os
+import gc
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+import pymupdf
+
+### Contents
+# current_rss_mb
+# private_rss_mb
+# peak_rss_mb
+# reset_peak_rss
+# MemoryGuard
+# MemoryScheduler
+# LineSpool
+
+def current_rss_mb():
+    """Resident memory of this process now (Linux), or the peak where only that is available (0 where neither is)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        return peak_rss_mb()
+
+def private_rss_mb():
+    """
+    Memory only this process holds (Linux): its resident memory without the pages it shares with other processes, such as the pages a
+    forked worker still shares with its parent. The whole resident memory where the two can't be told apart.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            return sum(int(line.split()[1]) for line in f if line.startswith(("Private_Clean:", "Private_Dirty:"))) / 1024
+    except OSError:
+        return current_rss_mb()
+
+def peak_rss_mb():
+    """Peak resident memory of this process, since the start or the last reset_peak_rss(). 0 where it can't be measured (Windows)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource  # not on Windows
+    except ImportError:
+        return 0.0
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def reset_peak_rss():
+    """Starts a new peak measurement (Linux only). Returns False where the peak can't be reset."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+class MemoryGuard:
+    """
+    Holds the open pdf for a page loop and releases its memory as the loop goes.
+
+    MuPDF keeps every parsed object until the document is closed and decoded resources in its store, so every reopen_pages pages
+    (or at once when the process is over budget_mb) the document is closed, the store emptied, Python's young garbage collected (a full collection costs more than it frees) and the document reopened.
+    If that doesn't bring the process under the budget, the next release waits until it has grown another 10%, so a budget that is too low
+    doesn't make it reopen the pdf on every page.
+    With private the budget is checked against private_rss_mb, for a worker whose share of the budget leaves out what it shares with its parent.
+    """
+
+    def __init__(self, pdf_path, budget_mb=None, reopen_pages=25, private=False):
+        self.pdf_path = pdf_path
+        self.budget_mb = budget_mb
+        self.rss_mb = private_rss_mb if private else current_rss_mb
+        self.reopen_pages = reopen_pages
+        self.doc = pymupdf.open(pdf_path)
+        self.pages_since_open = 0
+        self.release_above_mb = budget_mb
+        # releases that left the process over the budget
+        self.over_budget = 0
+
+    def page_done(self):
+        """Call after each page. Returns the document to use for the next page (it may have been reopened)."""
+        self.pages_since_open += 1
+        over_budget = self.budget_mb and self.rss_mb() > self.release_above_mb
+        if over_budget or self.pages_since_open >= self.reopen_pages:
+            self.release()
+
+            rss_mb = self.rss_mb()
+            if self.budget_mb and rss_mb > self.budget_mb:
+                if not self.over_budget:
+                    print(f"Memory budget of {self.budget_mb} MB exceeded ({rss_mb:.0f} MB after releasing the pdf), continuing")
+                self.over_budget += 1
+                self.release_above_mb = rss_mb * 1.1
+            elif self.budget_mb:
+                self.release_above_mb = self.budget_mb
+        return self.doc
+
+    def release(self):
+        """Closes the document, empties MuPDF's store and reopens the document."""
+        self.doc.close()
+        pymupdf.TOOLS.store_shrink(100)
+        gc.collect(1)
+        self.doc = pymupdf.open(self.pdf_path)
+        self.pages_since_open = 0
+
+    def close(self):
+        self.doc.close()
+
+class MemoryScheduler:
+    """
+    Runs calls on an executor while their projected memory stays under a budget, so more run at once when they are light and fewer when they are heavy.
+
+    Each call comes with its estimated peak (MB). A call is only started while resting_mb (the processes' memory without any work)
+    plus the estimates of the calls still running plus its own stays under budget_mb, and never more than max_running at once.
+    One call is always allowed to run, however heavy, so a budget that is too low makes the run serial rather than stuck.
+    Results are returned in call order, with at most window calls started ahead of the one being read.
+    """
+
+    def __init__(self, executor, budget_mb, max_running, resting_mb, window=None):
+        self.executor = executor
+        self.budget_mb = budget_mb
+        self.max_running = max_running
+        self.resting_mb = resting_mb
+        self.window = window or max_running * 2
+        # calls held back by the budget, and the most calls that ran at once
+        self.throttled = 0
+        self.most_running = 0
+
+    def map(self, function, calls, costs, labels=None):
+        """Like executor.map over a list of argument tuples, with their estimated MB. labels name the calls in the throttle messages."""
+        labels = labels or [str(index) for index in range(len(calls))]
+        serial = self.resting_mb >= self.budget_mb
+        if serial:
+            print(f"Memory budget of {self.budget_mb} MB is below the ~{self.resting_mb:.0f} MB the processes hold at rest, running one call at a time")
+        pending = deque()
+        next_call = 0
+        held = None
+
+        while next_call < len(calls) or pending:
+            while next_call < len(calls) and len(pending) < self.window:
+                running = [(future, cost) for future, cost in pending if not future.done()]
+                if len(running) >= self.max_running:
+                    break
+                projected_mb = self.resting_mb + sum(cost for _, cost in running)
+                if running and projected_mb + costs[next_call] > self.budget_mb:
+                    if held != next_call:
+                        held = next_call
+                        self.throttled += 1
+                        if not serial:
+                            print(f"Memory budget: holding {labels[next_call]} (~{costs[next_call]:.0f} MB) until {len(running)} running "
+                                  f"{'call finishes' if len(running) == 1 else 'calls finish'}, {projected_mb:.0f} of {self.budget_mb} MB in use")
+                    break
+                pending.append((self.executor.submit(function, *calls[next_call]), costs[next_call]))
+                next_call += 1
+                self.most_running = max(self.most_running, len(running) + 1)
+
+            if pending[0][0].done():
+                yield pending.popleft()[0].result()
+            else:
+                wait([future for future, _ in pending if not future.done()], return_when=FIRST_COMPLETED)
+
+class LineSpool:
+    """
+    A list of text lines (manifest and spine entries) that moves to a temporary file once it passes max_size bytes.
+    Supports append and iteration, so "".join() works on it like on a list.
+    """
+
+    def __init__(self, max_size=1024 * 1024):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size, mode="w+", encoding="utf-8")
+
+    def append(self, line):
+        self.file.write(line)
+
+    def __iter__(self):
+        self.file.seek(0)
+        yield from self.file
+        self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,118 @@
+'''
+Page cache
+
+Keeps each converted page (xhtml and background image) on disk, keyed by a fingerprint of the page, so reruns only convert the pages that changed.
+'''
+
+import os
+import json
+import hashlib
+
+### Contents
+# PageCache
+# font_folder_fingerprint
+
+# bump when the generated xhtml or images change so old entries are not reused
+CACHE_VERSION = 6
+
+class PageCache:
+    """
+    On-disk cache of converted pages.
+
+    Entries are stored as <key>.json (xhtml and page details) and images/<name> (shared background images).
+    Every use touches the file's mtime, and evict() removes the least recently used files until the cache is under max_bytes.
+    The object holds no open files so it can be passed to worker processes.
+    """
+
+    def __init__(self, cache_dir, max_bytes, base_key=""):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Options and fonts folder fingerprint shared by every page of the run
+        self.base_key = base_key
+        os.makedirs(os.path.join(cache_dir, "images"), exist_ok=True)
+
+    def page_key(self, page_context, image_names, page_options):
+        """
+        Fingerprint of everything the page's output depends on: content stream, fonts, images and options.
+        Apart from the cover the page number is left out, so pages with the same content share an entry (relabel_page_html gives each its own labels).
+        """
+        key = hashlib.sha1()
+        key.update(f"{CACHE_VERSION}|{self.base_key}|".encode("utf-8"))
+        key.update(json.dumps(page_options, sort_keys=True).encode("utf-8"))
+        key.update(json.dumps([tuple(page_context.rect), page_context.fonts, image_names, page_context.page_num == 0]).encode("utf-8"))
+        key.update(page_context.content_bytes())
+        return key.hexdigest()
+
+    def get(self, key):
+        """Returns the cached page details, or None on a miss."""
+        entry_path = os.path.join(self.cache_dir, f"{key}.json")
+        try:
+            with open(entry_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # The image may have been evicted separately
+        image_filename = entry.get("image_filename")
+        if image_filename and not os.path.exists(self.image_path(image_filename)):
+            return None
+
+        self._touch(entry_path)
+        if image_filename:
+            self._touch(self.image_path(image_filename))
+        return entry
+
+    def put(self, key, entry, image_data=None):
+        """Stores the page details and, if given, its encoded background image."""
+        image_filename = entry.get("image_filename")
+        if image_filename and image_data is not None:
+            self._write(self.image_path(image_filename), image_data)
+        self._write(os.path.join(self.cache_dir, f"{key}.json"), json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+
+    def image_path(self, image_filename):
+        return os.path.join(self.cache_dir, "images", image_filename)
+
+    def read_image(self, image_filename):
+        with open(self.image_path(image_filename), "rb") as f:
+            return f.read()
+
+    def evict(self):
+        """Removes least recently used files until the cache fits in max_bytes. Returns (files removed, bytes kept)."""
+        cache_files = []
+        for folder in (self.cache_dir, os.path.join(self.cache_dir, "images")):
+            for file_name in os.listdir(folder):
+                file_path = os.path.join(folder, file_name)
+                if os.path.isfile(file_path):
+                    stat = os.stat(file_path)
+                    cache_files.append((stat.st_mtime, stat.st_size, file_path))
+
+        total_bytes = sum(size for _, size, _ in cache_files)
+        removed = 0
+        for _, size, file_path in sorted(cache_files):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(file_path)
+            total_bytes -= size
+            removed += 1
+        return removed, total_bytes
+
+    def _write(self, path, data):
+        # Write to a temporary name first so a worker never reads a half written entry
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+def font_folder_fingerprint(font_list):
+    """Names, sizes and dates of the fonts in the fonts folder, so adding or replacing a font invalidates the cache."""
+    fingerprint = []
+    for font in sorted(font_list, key=lambda font: font["font_name"]):
+        stat = os.stat(font["font_path"])
+        fingerprint.append(f"{font['font_name']}:{stat.st_size}:{int(stat.st_mtime)}")
+    return hashlib.sha1("|".join(fingerprint).encode("utf-8")).hexdigest()
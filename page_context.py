@@ -0,0 +1,63 @@
+'''
+Page context
+
+Everything the conversion reads from a pdf page, extracted once and shared by the html generation, the json export, the font inventory and the page cache.
+'''
+
+import pymupdf
+
+### Contents
+# PageContext
+
+class PageContext:
+    """
+    Per-page extraction shared by all stages.
+
+    The image and font tables are read when the context is made (they are cheap). The text is extracted on first use from a single TextPage,
+    without image blocks unless keep_images is set, so a page served from the cache never pays for text extraction.
+    """
+
+    def __init__(self, page, keep_images=False):
+        self.page = page
+        self.page_num = page.number
+        self.rect = page.rect
+        self.images = page.get_images(full=True)
+        self.fonts = page.get_fonts()
+        self.keep_images = keep_images
+        self._text_dict = None
+
+    @property
+    def text_dict(self):
+        """The page's get_text("dict") structure, from one TextPage."""
+        if self._text_dict is None:
+            flags = pymupdf.TEXTFLAGS_DICT
+            if not self.keep_images:
+                flags &= ~pymupdf.TEXT_PRESERVE_IMAGES
+            textpage = self.page.get_textpage(flags=flags)
+            self._text_dict = textpage.extractDICT()
+            textpage = None
+        return self._text_dict
+
+    def lines(self):
+        """The spans of each text line, line by line."""
+        for block in self.text_dict.get("blocks", []):
+            for line in block.get("lines", []):
+                yield line.get("spans", [])
+
+    def span_fonts(self):
+        """Font names as the text spans use them, in order of first use."""
+        font_names = []
+        for spans in self.lines():
+            for span in spans:
+                if span["font"] not in font_names:
+                    font_names.append(span["font"])
+        return font_names
+
+    def content_bytes(self):
+        """The page's content stream(s), for fingerprinting."""
+        return self.page.read_contents()
+
+    def close(self):
+        """Drops the page and the extracted text."""
+        self.page = None
+        self._text_dict = None
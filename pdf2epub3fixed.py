@@ -29,6 +29,7 @@ import json
 import base64
 from datetime import datetime
 from titlecase import titlecase
+from functions import merge_line_spans
 
 
 parser = argparse.ArgumentParser(description="Convert PDF to fixed-layout EPUB, conserving the table of contents")
@@ -47,6 +48,8 @@ parser.add_argument("--css_folder", type=str, help="Folder containing the css fi
 parser.add_argument("--cover_image", type=str, help="Path to the cover image")
 parser.add_argument("--urn", type=str, help="URN of the PDF file")
 parser.add_argument("--yaml_config", type=str, help="Path to the YAML configuration file")
+parser.add_argument("--merge_tolerance", type=float, default=2.0, help="Largest gap (px) between spans on a line that are joined into one element")
+parser.add_argument("--no_merge_spans", action="store_true", help="Write one positioned div per PDF span")
 
 args = parser.parse_args()
 
@@ -65,6 +68,7 @@ font_folder = args.font_folder
 css_folder = args.css_folder
 cover_image = args.cover_image
 urn = args.urn
+merge_tolerance = None if args.no_merge_spans else args.merge_tolerance
 
 # Default values
 defaults = {
@@ -155,6 +159,8 @@ def generate_font_list(folder_path):
 
 font_list = generate_font_list(font_folder)
 fonts_in_pdf = []
+# PDF spans and written divs, reported at the end
+text_node_counts = [0, 0]
 
 def write_meta_inf_container_xml(meta_inf_folder):
     """Write the META-INF/container.xml file"""
@@ -442,6 +448,7 @@ def create_epub_structure_from_pdf(pdf_path, output_folder, variant, generate_js
         page_html_files.append(f'<itemref idref="{page_id}" properties="{spread}"/>\n')
         # page_html_files.append(f'<itemref idref="page_{page_num + 1}"/>\n')
     print("pages processed.")
+    print(f"Text elements: {text_node_counts[0]} spans -> {text_node_counts[1]} divs")
 
     # Add a cover image if available  
     if os.path.exists(cover_image) :
@@ -498,34 +505,50 @@ def generate_fixed_layout_html_selectable(page, page_num, images_folder, image_c
     html_content += f'<img alt="ALT_TEXT_HERE" src="image/{image_filename}" style="position:absolute; left:0px; top:0px; width:{page_width}px; height:{page_height}px; z-index: -1;" />\n'
 
     text_instances = page.get_text("dict")
+    span_count = 0
+    div_count = 0
     if "blocks" in text_instances:
         for block in text_instances["blocks"]:
             if "lines" in block:
                 for line in block.get('lines', []):
+                    spans = []
                     for span in line.get('spans', []):
                         font_name = span["font"]
                         if font_name not in fonts_in_pdf:
                             fonts_in_pdf.append(font_name)
                         if 'text' in span:
-                            left = span['origin'][0]
-                            top = span['origin'][1]
-                            size = span['size']
-                            font = span['font']
-                            text = span['text']
-                            color = span['color']
-                            #adjust top to compensate for alignment
-                            top = top-size
-
-                            if int(color) != 0:
-                                hex_color = int_to_hex_color(int(color))
-                                text_color = f" color:{hex_color};"
-                            else: 
-                                text_color = ""
-                            
-                            if is_all_caps(text):
-                                html_content += f'<div style="left:{left:.2f}px; top:{top:.2f}px; font-size:{size:.2f}px; font-family:\'{font}\'; {text_color}"><p><strong>{titlecase(text)}</strong></p></div>\n'
-                            else:
-                                html_content += f'<div style="left:{left:.2f}px; top:{top:.2f}px; font-size:{size:.2f}px; font-family:\'{font}\';{text_color}"><p>{text}</p></div>\n'
+                            spans.append(span)
+                    span_count += len(spans)
+
+                    # one div per run of touching spans, style changes inside it become inline spans
+                    for run in merge_line_spans(spans, merge_tolerance, is_all_caps):
+                        div_count += 1
+                        left = run['origin'][0]
+                        top = run['origin'][1]
+                        size = run['parts'][0]['size']
+                        font = run['parts'][0]['font']
+                        color = run['parts'][0]['color']
+                        #adjust top to compensate for alignment
+                        top = top-size
+
+                        if int(color) != 0:
+                            hex_color = int_to_hex_color(int(color))
+                            text_color = f" color:{hex_color};"
+                        else: 
+                            text_color = ""
+
+                        text = ""
+                        for part_index, part in enumerate(run['parts']):
+                            part_text = f"<strong>{titlecase(part['text'])}</strong>" if is_all_caps(part['text']) else part['text']
+                            if part_index > 0:
+                                part_color = f" color:{int_to_hex_color(int(part['color']))};" if int(part['color']) != 0 else ""
+                                part_text = f'<span style="font-size:{part["size"]:.2f}px; font-family:\'{part["font"]}\';{part_color}">{part_text}</span>'
+                            text += part_text
+
+                        html_content += f'<div style="left:{left:.2f}px; top:{top:.2f}px; font-size:{size:.2f}px; font-family:\'{font}\';{text_color}"><p>{text}</p></div>\n'
+
+    text_node_counts[0] += span_count
+    text_node_counts[1] += div_count
 
     # html_content = process_red_boxes_links(page, html_content)
     html_content += "</body></html>"
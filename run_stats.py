@@ -0,0 +1,124 @@
+'''
+Run stats
+
+Times the stages of a conversion and counts what they produce, per page and for the whole run, and writes them as a json report.
+'''
+
+import json
+import time
+from contextlib import contextmanager
+
+from memory_guard import reset_peak_rss, peak_rss_mb
+
+### Contents
+# StageTimes
+# PageStats
+# RunStats
+# merge_page_stats
+# save_report
+
+class StageTimes:
+    """
+    Seconds spent per stage and counters.
+
+    With track_memory the peak resident memory (MB) during each stage is kept too. The peak is reset when a stage starts,
+    so it is only measured for outer stages, not for a stage inside another one.
+    """
+
+    def __init__(self, track_memory=False):
+        self.seconds = {}
+        self.counts = {}
+        self.peak_mb = {}
+        self.track_memory = track_memory
+        self._depth = 0
+
+    @contextmanager
+    def stage(self, name):
+        measure_memory = self.track_memory and self._depth == 0 and reset_peak_rss()
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self._depth -= 1
+            if measure_memory:
+                self.peak_mb[name] = max(self.peak_mb.get(name, 0.0), round(peak_rss_mb(), 1))
+
+    def add(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+class PageStats(StageTimes):
+    """
+    Stage times and counters for one page.
+
+    Made where the page is converted (possibly a worker process) and sent back with the page result as a plain dict (as_dict).
+    details holds values that aren't added up over the run, like the jpeg quality chosen for the page's image.
+    """
+
+    def __init__(self, page_num, track_memory=False):
+        super().__init__(track_memory)
+        self.page_num = page_num
+        self.details = {}
+
+    def as_dict(self):
+        return {"page": self.page_num, "seconds": self.seconds, "counts": self.counts, "peak_mb": self.peak_mb, "details": self.details}
+
+class RunStats(StageTimes):
+    """
+    Collects the page stats of a run and the run-level stages (writing the opf, fonts, zip), and builds the report.
+
+    Page stage times are summed over the pages, so with worker processes they add up to more than the run's wall time.
+    """
+
+    def __init__(self, track_memory=False):
+        super().__init__(track_memory)
+        self.start = time.perf_counter()
+        self.pages = []
+
+    def add_page(self, page_stats):
+        """Adds a page's as_dict() result."""
+        self.pages.append(page_stats)
+
+    def report(self, **details):
+        """The report as a dict: run details, totals per stage and counter, the slowest pages and every page."""
+        page_seconds = {}
+        page_counts = {}
+        stage_peaks = dict(self.peak_mb)
+        for page in self.pages:
+            for name, seconds in page["seconds"].items():
+                page_seconds[name] = page_seconds.get(name, 0.0) + seconds
+            for name, count in page["counts"].items():
+                page_counts[name] = page_counts.get(name, 0) + count
+            for name, peak in page.get("peak_mb", {}).items():
+                stage_peaks[name] = max(stage_peaks.get(name, 0.0), peak)
+
+        slowest = sorted(self.pages, key=lambda page: page["seconds"].get("page", 0.0), reverse=True)[:10]
+        return {
+            **details,
+            "total_seconds": round(time.perf_counter() - self.start, 4),
+            "run_seconds": {name: round(seconds, 4) for name, seconds in self.seconds.items()},
+            "page_seconds": {name: round(seconds, 4) for name, seconds in sorted(page_seconds.items(), key=lambda item: -item[1])},
+            "counts": {**page_counts, **self.counts},
+            # with track_memory: the highest peak resident memory (MB) seen during each stage, over all pages
+            "stage_peak_mb": dict(sorted(stage_peaks.items(), key=lambda item: -item[1])),
+            "slowest_pages": [{"page": page["page"], "seconds": round(page["seconds"].get("page", 0.0), 4)} for page in slowest],
+            "pages": [
+                {"page": page["page"], "seconds": {name: round(seconds, 5) for name, seconds in page["seconds"].items()}, "counts": page["counts"], "peak_mb": page.get("peak_mb", {}), "details": page.get("details", {})}
+                for page in sorted(self.pages, key=lambda page: page["page"])
+            ],
+        }
+
+def merge_page_stats(page_stats, other):
+    """Adds the stage times, counts, peaks and details of other into page_stats (both as_dict() results of the same page, e.g. its image encoded on another thread)."""
+    for name, seconds in other["seconds"].items():
+        page_stats["seconds"][name] = page_stats["seconds"].get(name, 0.0) + seconds
+    for name, count in other["counts"].items():
+        page_stats["counts"][name] = page_stats["counts"].get(name, 0) + count
+    for name, peak in other["peak_mb"].items():
+        page_stats["peak_mb"][name] = max(page_stats["peak_mb"].get(name, 0.0), peak)
+    page_stats["details"].update(other["details"])
+
+def save_report(report, report_path):
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)